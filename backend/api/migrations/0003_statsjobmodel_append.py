@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0002_statsjobmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='statsjobmodel',
+            name='append',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_statsjobmodel_append'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayoutVersionModel',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_layoutversionmodel'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='referencemodel',
+            name='layout',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-18 13:03
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_referencemodel_layout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='layoutversionmodel',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,10 +1,13 @@
 from django.db import models
 from django.contrib.auth.models import User
 from django.core.validators import MinValueValidator, MaxValueValidator
+from django.utils import timezone
 
 
 class ReferenceModel(models.Model):
     ref = models.CharField(max_length=100, unique=True)
+    # [[x, y, w, h], ...] by cipher in the compact storage, the boxes being BoundingBoxModel rows otherwise
+    layout = models.JSONField(null=True, blank=True, default=None)
 
 
 class BoundingBoxModel(models.Model):
@@ -20,3 +23,31 @@ class BoundingBoxModel(models.Model):
     def __str__(self):
         return f"(x: {self.x}, y: {self.y}, w: {self.w}, h: {self.h})"
 
+
+
+class StatsJobModel(models.Model):
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUSES = [(PENDING, 'Pending'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed')]
+
+    pin_length = models.IntegerField()
+    append = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUSES, default=PENDING)
+    progress = models.FloatField(default=0)
+    message = models.TextField(blank=True, default='')
+
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"(pin_length: {self.pin_length}, status: {self.status}, progress: {self.progress:.0%})"
+
+
+class LayoutVersionModel(models.Model):
+    """
+    Single row counter bumped by every change of the reference layouts, so that the workers drop their cached copies
+    """
+    version = models.IntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
@@ -1,11 +1,22 @@
+from typing import *
+
 from rest_framework import serializers
 from .models import ReferenceModel, BoundingBoxModel
 
 
 class ReferenceSerializer(serializers.ModelSerializer):
+    bboxes = serializers.SerializerMethodField()
+
     class Meta:
         model = ReferenceModel
-        fields = '__all__'
+        exclude = ['layout']
+
+    @staticmethod
+    def get_bboxes(ref: ReferenceModel) -> List[List[int]]:
+        # [x, y, w, h] by cipher, from the boxes prefetched ordered by cipher in the row storage
+        if ref.layout is not None:
+            return ref.layout
+        return [[bb.x, bb.y, bb.w, bb.h] for bb in ref.boundingBoxes.all()]
 
     def create(self, validated_data):
         ref = ReferenceModel.objects.create(**validated_data)
@@ -1,3 +1,113 @@
-from django.test import TestCase
+import cv2
+import numpy as np
+from django.test import SimpleTestCase
 
-# Create your tests here.
+from api.config import config
+from api.views.digitRecognition import DigitRecognition
+from api.views.orderGuessing import OrderGuessing
+from api.views.statsRegistry import StatsBundle
+
+
+def random_stats(pin_length: int, rng: np.random.Generator) -> StatsBundle:
+    transition_mat = rng.random((10, 10))
+    prob_by_index = rng.random((10, pin_length))
+    freq = rng.random(10 ** pin_length)
+    return StatsBundle(pin_length, (0,), transition_mat / transition_mat.sum(axis=1, keepdims=True),
+                       prob_by_index / prob_by_index.sum(axis=0), freq / freq.sum())
+
+
+class RankingPathsTestCase(SimpleTestCase):
+    """
+    The top-k search gives the same most probable pins as the exhaustive enumeration
+    """
+
+    algorithms = [['index'], ['markov_chain'], ['frequency'], ['index', 'markov_chain', 'frequency']]
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def random_guesses(self, ciphers: np.ndarray) -> list[str]:
+        # mostly satisfiable: some positions of a permutation of the ciphers, sometimes any cipher
+        guesses = [str(cipher) if self.rng.random() < 0.2 else '' for cipher in self.rng.permutation(ciphers)]
+        if self.rng.random() < 0.1:
+            guesses[self.rng.integers(len(guesses))] = str(self.rng.integers(10))
+        return guesses
+
+    def test_most_probable_pins(self):
+        for pin_length in range(3, 8):
+            og = OrderGuessing(random_stats(pin_length, self.rng))
+            for _ in range(20):
+                ciphers = self.rng.integers(10, size=pin_length)
+                guesses = self.random_guesses(ciphers)
+                for algorithms in self.algorithms:
+                    with self.subTest(ciphers=ciphers.tolist(), guesses=guesses, algorithms=algorithms):
+                        enumerated = og.enumerate_most_probable_pins(ciphers, algorithms, guesses)
+                        searched = og.search_most_probable_pins(ciphers, algorithms, guesses)
+                        self.assertEqual([pin for pin, _ in enumerated], [pin for pin, _ in searched])
+                        np.testing.assert_allclose([prob for _, prob in enumerated],
+                                                   [prob for _, prob in searched], rtol=1e-12)
+
+    def test_best_sequence(self):
+        for pin_length in range(3, 7):
+            og = OrderGuessing(random_stats(pin_length, self.rng))
+            for _ in range(5):
+                sequences = self.rng.integers(10, size=(8, pin_length))
+                guesses = self.random_guesses(sequences[0])
+                for algorithms in self.algorithms:
+                    with self.subTest(sequences=sequences.tolist(), guesses=guesses, algorithms=algorithms):
+                        self.assertEqual(og.process_batch(sequences, algorithms, guesses),
+                                         og.search_best_sequence(sequences, algorithms, guesses))
+
+
+def synthetic_keypad(rng: np.random.Generator) -> np.ndarray:
+    """
+    Warped phone of a keypad with random position, spacing, font, letters under the digits and noise
+    """
+    image = np.full((config["height"], config["width"], 3), 255, dtype=np.uint8)
+    center = rng.integers(250, 360, size=2)
+    spacing = rng.integers((80, 60), (130, 100))
+    font = rng.choice([cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX])
+    scale, thickness = rng.uniform(1, 2), int(rng.integers(1, 4))
+
+    for cipher, position in zip([1, 2, 3, 4, 5, 6, 7, 8, 9, 0], DigitRecognition.pin_layout):
+        (w, h), _ = cv2.getTextSize(str(cipher), font, scale, thickness)
+        x, y = center + position * spacing
+        cv2.putText(image, str(cipher), (int(x - w / 2), int(y + h / 2)), font, scale, (0, 0, 0), thickness)
+        if rng.random() < 0.5:
+            cv2.putText(image, 'ABC', (int(x - w / 2), int(y + h)), font, scale / 4, (0, 0, 0), 1)
+
+    noise = rng.normal(0, rng.uniform(0, 20), image.shape)
+    return np.clip(image + noise, 0, 255).astype(np.uint8)
+
+
+class DigitRecognitionGroupingTestCase(SimpleTestCase):
+    """
+    The contour grouping finds the same shapes, thus the same layouts, as the DBSCAN clustering
+    """
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+        self.settings = dict(config["DigitRecognition"])
+
+    def tearDown(self):
+        config["DigitRecognition"].update(self.settings)
+
+    def run_grouping(self, grouping: str, image: np.ndarray) -> DigitRecognition:
+        config["DigitRecognition"]["grouping"] = grouping
+        return DigitRecognition(image.copy())
+
+    def test_shapes(self):
+        for _ in range(50):
+            image = synthetic_keypad(self.rng)
+            config["DigitRecognition"]["cluster_eps"] = int(self.rng.integers(3, 20))
+            config["DigitRecognition"]["cluster_min_samples"] = int(self.rng.integers(2, 40))
+            with self.subTest(eps=config["DigitRecognition"]["cluster_eps"],
+                              min_samples=config["DigitRecognition"]["cluster_min_samples"]):
+                np.testing.assert_array_equal(self.run_grouping('contours', image).extract_shape_contours(),
+                                              self.run_grouping('dbscan', image).extract_shape_contours())
+
+    def test_layouts(self):
+        for _ in range(20):
+            image = synthetic_keypad(self.rng)
+            np.testing.assert_array_equal(self.run_grouping('contours', image).process_data().data,
+                                          self.run_grouping('dbscan', image).process_data().data)
@@ -5,7 +5,11 @@ urlpatterns = [
     path("phone-references", views.PhoneReferences.as_view(), name="phone-references"),
     path("phone-references/<int:pk>", views.PhoneReferences.as_view()),
     path("build-statistics", views.build_statistics, name="build-statistics"),
+    path("build-statistics/<int:pk>", views.build_statistics_status, name="build-statistics-status"),
     path("find-pin-code", views.find_pin_code, name="find-pin-code"),
+    path("find-pin-codes", views.find_pin_codes, name="find-pin-codes"),
     path("find-pin-code-from-manual", views.find_pin_code_manual_corrected_inference, name="find-pin-code-from-manual"),
     path("update-pin-code", views.update_pin_code, name="update-pin-code"),
+    path("inference-metrics", views.inference_metrics, name="inference-metrics"),
+    path("images/<str:image_id>", views.get_image, name="image"),
 ]
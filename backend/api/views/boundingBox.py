@@ -86,22 +86,121 @@ class BoundingBox:
         return inter_area / union_area
 
 
+class BoundingBoxView:
+    """
+    Single box of a BoundingBoxes, reading and writing its row of the array in place.
+    Same interface as BoundingBox without a Python object per coordinate
+    """
+    __slots__ = ('row',)
+
+    def __init__(self, row: np.ndarray) -> None:
+        self.row = row
+
+    x = property(lambda self: self.row[0], lambda self, value: self.row.__setitem__(0, value))
+    y = property(lambda self: self.row[1], lambda self, value: self.row.__setitem__(1, value))
+    w = property(lambda self: self.row[2], lambda self, value: self.row.__setitem__(2, value))
+    h = property(lambda self: self.row[3], lambda self, value: self.row.__setitem__(3, value))
+
+    scale = BoundingBox.scale
+    xywh = BoundingBox.xywh
+    xyxy = BoundingBox.xyxy
+    pyplot_formatting = BoundingBox.pyplot_formatting
+    get_center = BoundingBox.get_center
+
+    def iou(self, other: 'BoundingBox | BoundingBoxView') -> float:
+        # same definition as iou_matrix
+        return float(iou_matrix(BoundingBoxes(self.row), BoundingBoxes([other.x, other.y, other.w, other.h]))[0, 0])
+
+    def __repr__(self) -> str:
+        return f"BoundingBoxView({', '.join(str(value) for value in self.row.tolist())})"
+
+
+class BoundingBoxes:
+    """
+    Set of bounding boxes backed by one contiguous (N, 4) float array of [x, y, w, h] rows (top left corner),
+    so that the whole set is handled by array operations
+    """
+
+    def __init__(self, data: np.ndarray | List[List[float]] | None = None) -> None:
+        self.data = np.ascontiguousarray(np.zeros((0, 4)) if data is None else data, dtype=np.float64).reshape(-1, 4)
+
+    @classmethod
+    def from_centers(cls: Type['BoundingBoxes'], data: np.ndarray) -> 'BoundingBoxes':
+        # [x_center, y_center, w, h] rows, as predicted by the detection model
+        data = np.asarray(data, dtype=np.float64).reshape(-1, 4)
+        return cls(np.concatenate((data[:, :2] - data[:, 2:] / 2, data[:, 2:]), axis=1))
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int | slice | np.ndarray) -> 'BoundingBoxView | BoundingBoxes':
+        if isinstance(index, (int, np.integer)):
+            return BoundingBoxView(self.data[index])
+        return BoundingBoxes(self.data[index])
+
+    def __iter__(self) -> Iterator[BoundingBoxView]:
+        return map(BoundingBoxView, self.data)
+
+    def __repr__(self) -> str:
+        return f"BoundingBoxes({self.data.tolist()})"
+
+    def xywh(self) -> List[List[int]]:
+        # top left corner and width and height of each bounding box, as JSON serialisable lists
+        # built in one pass over the array rather than box by box
+        return self.data.astype(int).tolist()
+
+    def xyxy(self) -> np.ndarray:
+        # top left and bottom right corners of each bounding box
+        return np.concatenate((self.data[:, :2], self.data[:, :2] + self.data[:, 2:]), axis=1)
+
+    def centers(self) -> np.ndarray:
+        return self.data[:, :2] + self.data[:, 2:] / 2
+
+    def areas(self) -> np.ndarray:
+        return self.data[:, 2] * self.data[:, 3]
+
+    def scale(self, x_fact: float, y_fact: float) -> None:
+        self.data *= [x_fact, y_fact, x_fact, y_fact]
+
+
+def iou_matrix(a: BoundingBoxes, b: BoundingBoxes) -> np.ndarray:
+    """
+    (len(a), len(b)) intersection over union of every pair of boxes
+    """
+    a_xyxy, b_xyxy = a.xyxy()[:, None, :], b.xyxy()[None, :, :]
+    inter_w = np.minimum(a_xyxy[..., 2], b_xyxy[..., 2]) - np.maximum(a_xyxy[..., 0], b_xyxy[..., 0])
+    inter_h = np.minimum(a_xyxy[..., 3], b_xyxy[..., 3]) - np.maximum(a_xyxy[..., 1], b_xyxy[..., 1])
+    inter_area = np.clip(inter_w, 0, None) * np.clip(inter_h, 0, None)
+    union_area = a.areas()[:, None] + b.areas()[None, :] - inter_area
+
+    return np.divide(inter_area, union_area, out=np.zeros_like(inter_area), where=union_area > 0)
+
+
 def select_bounding_boxes(
         ciphers: List[int],
         inferred_ciphers: List[int],
-        inferred_bboxes: List[BoundingBox],
-        reference_bboxes: List[BoundingBox]
-) -> List[BoundingBox]:
-
-    bboxes = []
-
-    for i, cipher in enumerate(ciphers):
-        if cipher in inferred_ciphers:
-            bbox = inferred_bboxes[inferred_ciphers.index(cipher)]
-            bboxes.append(bbox)
-            inferred_ciphers.remove(cipher)
-            inferred_bboxes.remove(bbox)
-        else:
-            bboxes.append(reference_bboxes[cipher])
-
-    return bboxes
+        inferred_bboxes: BoundingBoxes,
+        reference_bboxes: BoundingBoxes
+) -> BoundingBoxes:
+    """
+    Box of each cipher of the PIN code: the detected one for the first occurrence of a detected cipher,
+    the one of the reference otherwise
+    """
+    ciphers = np.asarray(ciphers, dtype=int)
+    inferred_ciphers = np.asarray(inferred_ciphers, dtype=int)
+
+    # index of the detected box of each cipher, the first one if several claim it
+    detected = np.full(len(reference_bboxes), -1)
+    detected[inferred_ciphers[::-1]] = np.arange(len(inferred_ciphers))[::-1]
+
+    _, first_occurrences = np.unique(ciphers, return_index=True)
+    is_first = np.zeros(len(ciphers), dtype=bool)
+    is_first[first_occurrences] = True
+
+    indexes = np.where(is_first, detected[ciphers], -1)
+    data = np.where(
+        (indexes >= 0)[:, None],
+        inferred_bboxes.data[np.maximum(indexes, 0)] if len(inferred_bboxes) else 0,
+        reference_bboxes.data[ciphers]
+    )
+    return BoundingBoxes(data)
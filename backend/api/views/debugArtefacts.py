@@ -0,0 +1,99 @@
+from queue import Queue, Full
+from typing import *
+import os
+import re
+import threading
+import time
+
+import cv2
+
+from api.config import config
+from api.views.inferenceBackends import YoloPrediction
+
+
+class ArtefactSink:
+    """
+    Opt-in debug output of the annotated predictions. The requests only enqueue their results, a background
+    thread draws and writes them, then evicts the oldest files beyond the age and size limits.
+    Results are dropped rather than delaying a request when the queue is full
+    """
+
+    def __init__(self, directory: str, max_bytes: int, max_age: float, queue_size: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.queue: Queue[Tuple[str, YoloPrediction]] = Queue(queue_size)
+        self.dropped = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.thread = threading.Thread(target=self.run, name="artefact-sink", daemon=True)
+        self.thread.start()
+
+    def submit(self, name: str, result: YoloPrediction) -> None:
+        try:
+            self.queue.put_nowait((name, result))
+        except Full:
+            with self.lock:
+                self.dropped += 1
+
+    def run(self) -> None:
+        while True:
+            name, result = self.queue.get()
+            try:
+                self.write(name, result)
+                self.evict()
+            except Exception as e:
+                print(f"Debug artefact {name} not written: {e!r}")
+
+    def write(self, name: str, result: YoloPrediction) -> None:
+        # the names come from the uploads
+        name = re.sub(r'[^\w.-]', '_', name)
+        path = os.path.join(self.directory, f"{time.time_ns()}_{name}.jpg")
+        cv2.imwrite(path, result.plot())
+
+    def evict(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        files.sort()
+        total_size = sum(size for _, size, _ in files)
+        now = time.time()
+        for mtime, size, path in files:
+            if total_size <= self.max_bytes and now - mtime <= self.max_age:
+                break
+            os.remove(path)
+            total_size -= size
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'queue_depth': self.queue.qsize(), 'dropped': self.dropped}
+
+
+artefact_sink = None
+artefact_sink_lock = threading.Lock()
+
+
+def get_artefact_sink() -> ArtefactSink | None:
+    global artefact_sink
+    if not config["DebugArtefacts"]["enabled"]:
+        return None
+
+    # one background writer per process
+    with artefact_sink_lock:
+        if artefact_sink is None:
+            artefact_sink = ArtefactSink(
+                config["DebugArtefacts"]["dir"],
+                config["DebugArtefacts"]["max_bytes"],
+                config["DebugArtefacts"]["max_age"],
+                config["DebugArtefacts"]["queue_size"]
+            )
+    return artefact_sink
+
+
+def get_artefact_metrics() -> Dict[str, int] | None:
+    # None until the models of this process are loaded, or when disabled
+    return None if artefact_sink is None else artefact_sink.stats()
@@ -2,16 +2,14 @@ from typing import *
 
 import cv2
 import numpy as np
-from sklearn.cluster import DBSCAN
-from torch.ao.quantization.fx.lower_to_fbgemm import lower_to_fbgemm
-
-from api.models import ReferenceModel, BoundingBoxModel
-
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import KDTree
 
 from api.config import config
-from api.views.boundingBox import BoundingBox
-from api.views.pyplotWrapper import PyplotWrapper
-from matplotlib import pyplot as plt
+from api.views.boundingBox import BoundingBoxes, iou_matrix
+from api.views.referenceLayouts import reference_layouts
 
 
 class DigitRecognition:
@@ -35,6 +33,9 @@ class DigitRecognition:
     def __init__(self, img: np.ndarray):
         self.image = img
         self.canny_thresholds = config["DigitRecognition"]["canny_thresholds"]
+        self.grouping = config["DigitRecognition"]["grouping"]
+        self.cluster_eps = config["DigitRecognition"]["cluster_eps"]
+        self.cluster_min_samples = config["DigitRecognition"]["cluster_min_samples"]
 
         self.bounds = config["DigitRecognition"]["bounds"]
         self.width_bounds = config["width"] * np.array(self.bounds)
@@ -45,100 +46,118 @@ class DigitRecognition:
         self.digit_alignment_delta = config["DigitRecognition"]["digit_alignment_delta"]
         self.bbox_padding = config["DigitRecognition"]["bbox_padding"]
 
-    def extract_shape_contours(self):
+    def extract_shape_contours(self) -> np.ndarray:
+        """
+        Group the contours of the edges into individual shapes.
+        Return the [x_min, y_min, x_max, y_max] bounds of each shape
+        """
         self.image = cv2.cvtColor(self.image, cv2.COLOR_BGR2GRAY)
 
         # edge detection using canny
         self.images_edges = cv2.Canny(self.image, self.canny_thresholds[0], self.canny_thresholds[1])
 
         contours, _ = cv2.findContours(self.images_edges, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
-        contours = np.vstack(contours).squeeze()
+        if len(contours) == 0:
+            return np.zeros((0, 4))
 
-        # get individual contours
-        clusters = DBSCAN(
-            eps=config["DigitRecognition"]["cluster_eps"],
-            min_samples=config["DigitRecognition"]["cluster_min_samples"]).fit(contours)
+        points = np.vstack(contours).reshape(-1, 2)
+        if self.grouping == 'dbscan':
+            return self.cluster_points(points)
 
-        # split the original contours into individuals
-        clusters_xy = [[] for _ in range(np.max(clusters.labels_) + 1)]
-        for i, cluster_id in enumerate(clusters.labels_):
-            if cluster_id == -1:
-                continue
+        return self.group_contours(points)
 
-            clusters_xy[cluster_id].append(list(contours[i]))
+    def cluster_points(self, points: np.ndarray) -> np.ndarray:
+        # get individual contours, sklearn being only imported by the workers which need it
+        from sklearn.cluster import DBSCAN
 
-        return clusters_xy
+        labels = DBSCAN(eps=self.cluster_eps, min_samples=self.cluster_min_samples).fit(points).labels_
+        is_clustered = labels != -1
+        return get_groups_bounds(points[is_clustered], labels[is_clustered])
 
-    def filter_clusters(self, clusters: List):
+    def group_contours(self, points: np.ndarray) -> np.ndarray:
+        """
+        Same groups of the contour points as the DBSCAN clustering, without its per-point loop: the pairs of
+        points within the clustering epsilon come from a k-d tree, the clusters are the connected components
+        of the core points (at least min_samples neighbours, themselves included) and each border point
+        joins the first cluster, by DBSCAN's numbering, of its core neighbours. The other points are noise
+        """
+        # the inner and outer contours share many points, counted by their multiplicity
+        keys = points[:, 0].astype(np.int64) << 32 | points[:, 1]
+        _, firsts, counts = np.unique(keys, return_index=True, return_counts=True)
+        points = points[firsts]
+        n = len(points)
+
+        pairs = KDTree(points).query_pairs(self.cluster_eps, output_type='ndarray')
+        n_neighbours = (counts + np.bincount(pairs[:, 0], weights=counts[pairs[:, 1]], minlength=n) +
+                        np.bincount(pairs[:, 1], weights=counts[pairs[:, 0]], minlength=n))
+        is_core = n_neighbours >= self.cluster_min_samples
+
+        core_pairs = pairs[is_core[pairs[:, 0]] & is_core[pairs[:, 1]]]
+        graph = csr_matrix((np.ones(len(core_pairs), dtype=bool), (core_pairs[:, 0], core_pairs[:, 1])), shape=(n, n))
+        _, components = connected_components(graph, directed=False)
+
+        # DBSCAN numbers the clusters by the first of their core points in the contours
+        core_ids = np.flatnonzero(is_core)
+        _, core_components = np.unique(components[core_ids], return_inverse=True)
+        starts = np.full(core_components.max(initial=-1) + 1, len(keys))
+        np.minimum.at(starts, core_components, firsts[core_ids])
+        numbers = np.empty(len(starts), dtype=np.int64)
+        numbers[np.argsort(starts)] = np.arange(len(starts))
+        labels = np.full(n, -1, dtype=np.int64)
+        labels[core_ids] = numbers[core_components]
+
+        # the border points, neighbours of core points, join the first of their clusters
+        is_mixed = is_core[pairs[:, 0]] != is_core[pairs[:, 1]]
+        border_pairs = np.where(is_core[pairs[is_mixed, :1]], pairs[is_mixed, ::-1], pairs[is_mixed])
+        border_labels = np.full(n, n, dtype=np.int64)
+        np.minimum.at(border_labels, border_pairs[:, 0], labels[border_pairs[:, 1]])
+        labels = np.where(border_labels < n, border_labels, labels)
+
+        is_clustered = labels != -1
+        return get_groups_bounds(points[is_clustered], labels[is_clustered])
+
+    def filter_clusters(self, clusters: np.ndarray) -> np.ndarray:
         """
         Filter individual contours, eliminating those that are too wide or too close to the edge.
         Retain the centroids of the ones that respect those criteria
         """
-        centroids = []
-        for cluster in clusters:
-            cluster = np.array(cluster)
-            # get the bounding box
-            tl = np.min(cluster, axis=0)
-            br = np.max(cluster, axis=0)
-            w = br[0] - tl[0]
-            h = br[1] - tl[1]
-            area = w * h
-            centroid = [tl[0] + w / 2, tl[1] + h / 2]
-
-            if (area > self.too_wide_area or not
-                ((self.width_bounds[0] < centroid[0] < self.width_bounds[1]) and
-                    (self.height_bounds[0] < centroid[1] < self.height_bounds[1]))):
-
-                continue
-
-            centroids.append(centroid)
-
-        centroids = np.array(centroids)
-        return centroids
+        tl, br = clusters[:, :2], clusters[:, 2:]
+        wh = br - tl
+        area = wh[:, 0] * wh[:, 1]
+        centroids = tl + wh / 2
+
+        is_kept = ((area <= self.too_wide_area) &
+                   (self.width_bounds[0] < centroids[:, 0]) & (centroids[:, 0] < self.width_bounds[1]) &
+                   (self.height_bounds[0] < centroids[:, 1]) & (centroids[:, 1] < self.height_bounds[1]))
+
+        return centroids[is_kept].reshape(-1, 2)
 
-    def extract_digit_matrix(self, centroids):
+    def extract_digit_matrix(self, centroids: np.ndarray) -> np.ndarray:
         """
         Isolate points that form a 3x3 matrix using geometric constraints.
         """
 
+        # centroids aligned on the same column (near_x) or row (near_y) of each centroid
+        distances = np.abs(centroids[:, None, :] - centroids[None, :, :])
+        is_other = ~np.eye(len(centroids), dtype=bool)
+        near_x = (distances[..., 0] < self.digit_alignment_delta[0]) & is_other
+        near_y = (distances[..., 1] < self.digit_alignment_delta[1]) & is_other
 
-        def get_average_spacing(points, axis_index):
-
-            p = np.array(points)[:, axis_index]
-            consecutive_distances = np.diff(np.sort(p))
-
-            return np.mean(consecutive_distances)
+        to_keep = (near_x.sum(axis=1) >= 2) & (near_y.sum(axis=1) >= 2)
+        near_x = near_x[to_keep] | np.eye(len(centroids), dtype=bool)[to_keep]
+        near_y = near_y[to_keep] | np.eye(len(centroids), dtype=bool)[to_keep]
 
-        to_keep = []
-        avg_spacings_x = []
-        avg_spacings_y = []
-        new_indexes = {}
-        for i, b in enumerate(centroids):
-            near_x = []
-            near_y = []
-            for j, bb in enumerate(centroids):
-                if i == j:
-                    continue
+        def get_average_spacing(is_near: np.ndarray, axis_index: int) -> np.ndarray:
+            # mean of the consecutive distances between the sorted coordinates of each row of points
+            p = np.where(is_near, centroids[None, :, axis_index], np.nan)
+            return np.nanmean(np.diff(np.sort(p, axis=1), axis=1), axis=1)
 
-                dx = abs(b[0] - bb[0])
-                dy = abs(b[1] - bb[1])
+        avg_spacings_x = get_average_spacing(near_y, 0)
+        avg_spacings_y = get_average_spacing(near_x, 1)
+        centroids = centroids[to_keep]
 
-                if dx < self.digit_alignment_delta[0]:
-                    near_x.append(bb)
-                if dy < self.digit_alignment_delta[1]:
-                    near_y.append(bb)
-
-
-            if len(near_x) >= 2 and len(near_y) >= 2:
-                to_keep.append(i)
-                new_indexes.update({i: len(avg_spacings_y)})
-                avg_spacings_x.append(get_average_spacing(np.append(near_y, b).reshape(-1, 2), 0))
-                avg_spacings_y.append(get_average_spacing(np.append(near_x, b).reshape(-1, 2), 1))
-
-        centroids = centroids[np.array(to_keep)]
-
-        x_q1, x_q3 = np.percentile(np.array(avg_spacings_x), [25, 75])
-        y_q1, y_q3 = np.percentile(np.array(avg_spacings_y), [25, 75])
+        x_q1, x_q3 = np.percentile(avg_spacings_x, [25, 75])
+        y_q1, y_q3 = np.percentile(avg_spacings_y, [25, 75])
         x_iqr = x_q3 - x_q1
         y_iqr = y_q3 - y_q1
 
@@ -148,7 +167,7 @@ class DigitRecognition:
         valid_indices = np.where((avg_spacings_x >= x_bounds[0]) & (avg_spacings_x <= x_bounds[1]) &
                                  (avg_spacings_y >= y_bounds[0]) & (avg_spacings_y <= y_bounds[1]))[0]
 
-        centroids  = centroids[valid_indices]
+        centroids = centroids[valid_indices]
 
         if centroids.shape[0] >= 9:
             centroids = centroids[np.argsort(centroids[:, 1])[:9]]
@@ -182,19 +201,17 @@ class DigitRecognition:
         # adjust all centroids for better alignment and create bounding boxes
         adj_centroids = r_center + DigitRecognition.pin_layout * [w, h]
 
-        bboxes = [BoundingBox(
-            adj_b[0] - w/3,
-            adj_b[1] - h/2,
-            2*w/3,
-            h
-        ) for adj_b in adj_centroids]
+        bboxes = BoundingBoxes(np.column_stack((
+            adj_centroids[:, 0] - w/3,
+            adj_centroids[:, 1] - h/2,
+            np.full(len(adj_centroids), 2*w/3),
+            np.full(len(adj_centroids), h)
+        )))
 
         # 0's bounding box is at the end thus we reposition it
-        bboxes.insert(0, bboxes[-1])
-        bboxes.pop(-1)
-        return bboxes
+        return bboxes[np.roll(np.arange(len(bboxes)), 1)]
 
-    def process_data(self) -> List[BoundingBox]:
+    def process_data(self) -> BoundingBoxes:
         """
         Method to execute the whole pipeline to extract digits' bounding boxes
         """
@@ -206,29 +223,53 @@ class DigitRecognition:
         return pin_bboxes
 
 
-def guess_ciphers(bboxes: List[BoundingBox], reference: str) -> Tuple[
+def get_groups_bounds(points: np.ndarray, groups_ids: np.ndarray) -> np.ndarray:
+    """
+    [x_min, y_min, x_max, y_max] of the points of each group, by increasing group id
+    """
+    if len(points) == 0:
+        return np.zeros((0, 4))
+
+    order = np.argsort(groups_ids, kind='stable')
+    starts = np.flatnonzero(np.diff(groups_ids[order], prepend=-2))
+    sorted_points = points[order]
+    return np.hstack((np.minimum.reduceat(sorted_points, starts), np.maximum.reduceat(sorted_points, starts)))
+
+
+def guess_ciphers(
+        bboxes: BoundingBoxes,
+        reference: str,
+        guesses: Dict[Hashable, Tuple[np.ndarray, np.ndarray]] | None = None
+) -> Tuple[
         np.array,
-        List[BoundingBox],
+        List[List[int]],
+        BoundingBoxes
 ]:
     """
-    "Guess" the ciphers used for the PIN code by taking the best IOU score
-    between the references and the inferred bounding boxes for each one
+    "Guess" the ciphers used for the PIN code by an optimal assignment (Hungarian algorithm) of the
+    inferred bounding boxes to the ones of the reference maximising the total IOU, so that two smudges
+    never claim the same cipher. Pairs under the minimum IOU are not matched.
+    Return the (cipher, IOU) of the matched boxes, the reference boxes and the matched boxes.
+    The guesses already made for the same boxes are reused while the layout of the reference is unchanged
     """
 
-    # get the correct reference bounding boxes from the database
-    ref_id = ReferenceModel.objects.get(ref=reference).id
-    refs_obj = BoundingBoxModel.objects.filter(ref=ref_id)
-    refs_dict = {bb.cipher: BoundingBox(bb.x, bb.y, bb.w, bb.h) for bb in refs_obj}
-    refs_bboxes = list(refs_dict.values())
+    refs_layout = reference_layouts.get(reference)
+    refs_bboxes = BoundingBoxes(refs_layout[:, 1:])
+
+    layout = refs_layout.tobytes()
+    if guesses is not None and layout in guesses:
+        pin, matched = guesses[layout]
+        return pin, refs_bboxes.xywh(), bboxes[matched]
 
-    pin = []
-    for bb in bboxes:
-        iou = np.array([bb.iou(ref_bb) for ref_bb in refs_bboxes], dtype=np.float32)
-        best_cipher = np.argmax(iou)
-        best_iou = float(iou[best_cipher])
-        pin.append((best_cipher, best_iou))
+    iou = iou_matrix(bboxes, refs_bboxes)
+    matched, refs_matched = linear_sum_assignment(iou, maximize=True)
+    is_kept = iou[matched, refs_matched] >= config["CipherGuessing"]["min_iou"]
+    matched, refs_matched = matched[is_kept], refs_matched[is_kept]
 
     # TODO: handle less or more than six ciphers retrieved
     # --> if less use markov chain to guess more probable missing ciphers
     # --> if more then compute order for all sequence of 6 ciphers keep cipher with IOU > 0.9 in place
-    return np.array(pin), [ref.xywh() for ref in refs_bboxes]
+    pin = np.column_stack((refs_layout[refs_matched, 0], iou[matched, refs_matched])).reshape(-1, 2)
+    if guesses is not None:
+        guesses[layout] = (pin, matched)
+    return pin, refs_bboxes.xywh(), bboxes[matched]
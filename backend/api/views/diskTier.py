@@ -0,0 +1,79 @@
+from typing import *
+import os
+import threading
+
+
+class DiskTier:
+    """
+    Files of a directory shared by the workers, the least recently used ones (by mtime) being evicted beyond
+    max_bytes. Each worker keeps a running estimate of the size of the directory, counting its own writes,
+    and only scans the directory when the estimate goes over the limit. A scan evicts down to target_ratio
+    of the limit so that the next one is paid for by that much more writes
+    """
+    target_ratio = 0.9
+
+    def __init__(self, directory: str, max_bytes: int, extension: str):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.extension = extension
+        self.size = 0
+        self.lock = threading.Lock()
+        self.evict_lock = threading.Lock()
+
+        os.makedirs(self.directory, exist_ok=True)
+        # the files left by the previous runs and by the other workers
+        self.evict()
+
+    def get_path(self, name: str) -> str:
+        return os.path.join(self.directory, f"{name}{self.extension}")
+
+    def touch(self, name: str) -> None:
+        # recently used files are the last ones evicted
+        os.utime(self.get_path(name))
+
+    def write(self, name: str, write: Callable[[BinaryIO], None]) -> None:
+        # write aside and rename so that a worker never reads a partially written file,
+        # each thread having its own temporary file
+        path = self.get_path(name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            write(f)
+            size = f.tell()
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            self.size += size
+            if self.size <= self.max_bytes:
+                return
+
+        # a single scan at a time, the other threads' writes being counted by it
+        if self.evict_lock.acquire(blocking=False):
+            try:
+                self.evict()
+            finally:
+                self.evict_lock.release()
+
+    def evict(self) -> None:
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(self.extension):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total_size = sum(size for _, size, _ in files)
+        if total_size > self.max_bytes:
+            target = self.max_bytes * self.target_ratio
+            for _, size, path in sorted(files):
+                if total_size <= target:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total_size -= size
+
+        with self.lock:
+            self.size = total_size
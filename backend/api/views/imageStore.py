@@ -0,0 +1,111 @@
+from collections import OrderedDict
+from typing import *
+import hashlib
+import re
+import threading
+
+import cv2
+import numpy as np
+
+from api.config import config
+from api.views.diskTier import DiskTier
+
+
+CODECS = {
+    'jpeg': ('.jpg', cv2.IMWRITE_JPEG_QUALITY, 'image/jpeg'),
+    'webp': ('.webp', cv2.IMWRITE_WEBP_QUALITY, 'image/webp'),
+    'png': ('.png', None, 'image/png'),
+}
+
+
+class ImageStore:
+    """
+    Encoded images of the responses by content, served by their own endpoint so that the JSON responses
+    only carry their id. Least recently used images are evicted beyond max_bytes in memory.
+    The disk tier is shared by the workers, the image of a response being requested from any of them.
+    Without it, the store only works with a single worker
+    """
+
+    def __init__(self, max_bytes: int, codec: str, quality: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        if codec not in CODECS:
+            raise ValueError(f"Unknown image codec {codec}")
+
+        self.max_bytes = max_bytes
+        self.extension, quality_flag, self.content_type = CODECS[codec]
+        self.params = [] if quality_flag is None else [quality_flag, quality]
+        self.entries: OrderedDict[str, bytes] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.disk = DiskTier(disk_dir, disk_max_bytes, self.extension) if disk_dir else None
+
+    def get_id(self, image: np.ndarray) -> str:
+        # the same image encoded with other settings gets another id
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+        digest.update(f"{image.shape}{self.extension}{self.params}".encode())
+        return digest.hexdigest()
+
+    def put(self, image: np.ndarray, image_id: str | None = None) -> str:
+        image_id = image_id or self.get_id(image)
+        with self.lock:
+            if image_id in self.entries:
+                self.entries.move_to_end(image_id)
+                return image_id
+
+        ok, encoded = cv2.imencode(self.extension, image, self.params)
+        if not ok:
+            raise ValueError(f"The image could not be encoded as {self.extension}")
+
+        data = encoded.tobytes()
+        with self.lock:
+            self.insert(image_id, data)
+        self.save(image_id, data)
+        return image_id
+
+    def get(self, image_id: str) -> bytes | None:
+        with self.lock:
+            data = self.entries.get(image_id)
+            if data is not None:
+                self.entries.move_to_end(image_id)
+                return data
+
+        # stored by another worker
+        data = self.load(image_id)
+        if data is not None:
+            with self.lock:
+                self.insert(image_id, data)
+        return data
+
+    def insert(self, image_id: str, data: bytes) -> None:
+        if image_id not in self.entries:
+            self.entries[image_id] = data
+            self.size += len(data)
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def load(self, image_id: str) -> bytes | None:
+        # the ids come from the URLs
+        if self.disk is None or not re.fullmatch(r'[0-9a-f]+', image_id):
+            return None
+
+        try:
+            with open(self.disk.get_path(image_id), 'rb') as f:
+                data = f.read()
+            self.disk.touch(image_id)
+        except OSError:
+            # missing or evicted meanwhile
+            return None
+        return data
+
+    def save(self, image_id: str, data: bytes) -> None:
+        if self.disk is not None:
+            self.disk.write(image_id, lambda f: f.write(data))
+
+
+image_store = ImageStore(
+    config["ImageStore"]["max_bytes"],
+    config["ImageStore"]["codec"],
+    config["ImageStore"]["quality"],
+    config["ImageStore"]["disk_dir"],
+    config["ImageStore"]["disk_max_bytes"]
+)
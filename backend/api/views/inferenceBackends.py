@@ -0,0 +1,227 @@
+from typing import *
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+import cv2
+from filelock import FileLock
+
+from api.config import config
+
+
+class YoloPrediction:
+    """
+    Backend independent output of a YOLO model for one image: (N, 4) boxes as [x_center, y_center, w, h]
+    by decreasing confidence and, for segmentation models, the polygon of each mask (None without detection)
+    """
+
+    def __init__(self, image: np.ndarray, boxes: np.ndarray, polygons: List[np.ndarray] | None = None):
+        self.image = image
+        self.boxes = boxes
+        self.polygons = polygons
+
+    def plot(self) -> np.ndarray:
+        annotated = self.image.copy()
+        for x, y, w, h in self.boxes.astype(int):
+            cv2.rectangle(annotated, (x - w // 2, y - h // 2), (x + w // 2, y + h // 2), (0, 0, 255), 2)
+        for polygon in self.polygons or []:
+            cv2.polylines(annotated, [polygon.astype(np.int32)], True, (0, 255, 0), 2)
+        return annotated
+
+
+class TorchBackend:
+    """
+    The .pt weights run by ultralytics on PyTorch
+    """
+
+    def __init__(self, weights: str):
+        from ultralytics import YOLO
+
+        self.model = YOLO(weights)
+
+    def __call__(self, images: List[np.ndarray]) -> List[YoloPrediction]:
+        return [YoloPrediction(
+            image,
+            result.boxes.xywh.cpu().numpy(),
+            None if result.masks is None else [np.array(polygon) for polygon in result.masks.xy]
+        ) for image, result in zip(images, self.model(images))]
+
+
+class OnnxBackend:
+    """
+    The weights exported once to ONNX (optionally INT8 quantised) and run by ONNX Runtime on the CPU,
+    pre and post-processing (letterbox, NMS, masks) being done with numpy and OpenCV as by ultralytics
+    """
+
+    def __init__(
+            self,
+            weights: str,
+            quantize: bool = False,
+            intra_op_threads: int = 0,
+            imgsz: int = 640,
+            conf: float = 0.25,
+            iou: float = 0.7,
+            max_det: int = 300
+    ):
+        import onnxruntime as ort
+
+        self.imgsz = imgsz
+        self.conf = conf
+        self.iou = iou
+        self.max_det = max_det
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(
+            self.export(weights, imgsz, quantize), options, providers=['CPUExecutionProvider']
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    @staticmethod
+    def export(weights: str, imgsz: int, quantize: bool) -> str:
+        """
+        Path of the ONNX export of the weights, exported (and quantised) on first use.
+        The workers warming up together export once, the files being written aside then renamed
+        so that a worker never loads a partial model
+        """
+        onnx_path = os.path.splitext(weights)[0] + '.onnx'
+        quantized_path = os.path.splitext(weights)[0] + '.int8.onnx'
+        path = quantized_path if quantize else onnx_path
+        if os.path.exists(path):
+            return path
+
+        with FileLock(os.path.splitext(weights)[0] + '.onnx.lock'):
+            if not os.path.exists(onnx_path):
+                from ultralytics import YOLO
+
+                # the export is written next to the weights it is given, a copy in a private directory
+                with tempfile.TemporaryDirectory(dir=os.path.dirname(weights) or '.') as tmp_dir:
+                    tmp_weights = shutil.copy(weights, tmp_dir)
+                    # dynamic axes to run batches of any size, not simplified since ONNX Runtime
+                    # optimises the graph itself and onnxsim would be installed on the fly
+                    tmp_path = YOLO(tmp_weights).export(format='onnx', imgsz=imgsz, dynamic=True)
+                    os.replace(tmp_path, onnx_path)
+
+            if quantize and not os.path.exists(quantized_path):
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+
+                tmp_path = f"{quantized_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                quantize_dynamic(onnx_path, tmp_path, weight_type=QuantType.QUInt8)
+                os.replace(tmp_path, quantized_path)
+
+        return path
+
+    def __call__(self, images: List[np.ndarray]) -> List[YoloPrediction]:
+        inputs, transforms = zip(*(self.letterbox(image) for image in images))
+        outputs = self.session.run(None, {self.input_name: np.stack(inputs)})
+
+        predictions = []
+        for i, (image, transform) in enumerate(zip(images, transforms)):
+            protos = outputs[1][i] if len(outputs) > 1 else None
+            predictions.append(self.postprocess(image, outputs[0][i], protos, transform))
+        return predictions
+
+    def letterbox(self, image: np.ndarray) -> Tuple[np.ndarray, Tuple[float, int, int]]:
+        """
+        Resize keeping the aspect ratio and pad to a square, return the (3, imgsz, imgsz) RGB input
+        and the (gain, left pad, top pad) of the transformation
+        """
+        h, w = image.shape[:2]
+        gain = min(self.imgsz / h, self.imgsz / w)
+        new_w, new_h = round(w * gain), round(h * gain)
+        left, top = (self.imgsz - new_w) // 2, (self.imgsz - new_h) // 2
+
+        padded = np.full((self.imgsz, self.imgsz, 3), 114, dtype=np.uint8)
+        resized = image if (new_w, new_h) == (w, h) else cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+        padded[top:top + new_h, left:left + new_w] = resized
+
+        return padded[..., ::-1].transpose(2, 0, 1).astype(np.float32) / 255, (gain, left, top)
+
+    def postprocess(
+            self,
+            image: np.ndarray,
+            output: np.ndarray,
+            protos: np.ndarray | None,
+            transform: Tuple[float, int, int]
+    ) -> YoloPrediction:
+        # (4 + classes + mask coefficients, anchors) -> one row per anchor
+        output = output.T
+        n_masks = 0 if protos is None else protos.shape[0]
+        scores = output[:, 4:output.shape[1] - n_masks]
+        classes = scores.argmax(axis=1)
+        confidences = scores[np.arange(len(scores)), classes]
+
+        keep = confidences > self.conf
+        output, classes, confidences = output[keep], classes[keep], confidences[keep]
+
+        # class-aware NMS on [x_top_left, y_top_left, w, h] rectangles
+        rects = output[:, :4].copy()
+        rects[:, :2] -= rects[:, 2:] / 2
+        kept = cv2.dnn.NMSBoxesBatched(rects.tolist(), confidences.tolist(), classes.tolist(), self.conf, self.iou)
+        kept = np.asarray(kept, dtype=int).reshape(-1)[:self.max_det]
+        output = output[kept]
+
+        # back to the coordinates of the original image
+        gain, left, top = transform
+        boxes = output[:, :4].copy()
+        boxes[:, 0] -= left
+        boxes[:, 1] -= top
+        boxes /= gain
+        boxes = self.clip_boxes(boxes, image.shape[:2])
+
+        if protos is None:
+            return YoloPrediction(image, boxes)
+        if len(output) == 0:
+            return YoloPrediction(image, boxes, None)
+
+        masks = self.process_masks(protos, output[:, -n_masks:], output[:, :4])
+        return YoloPrediction(image, boxes, [self.mask_to_polygon(mask, transform, image.shape[:2]) for mask in masks])
+
+    @staticmethod
+    def clip_boxes(boxes: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+        h, w = shape
+        xyxy = np.concatenate((boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2), axis=1)
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clip(0, w)
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clip(0, h)
+        return np.concatenate(((xyxy[:, :2] + xyxy[:, 2:]) / 2, xyxy[:, 2:] - xyxy[:, :2]), axis=1)
+
+    def process_masks(self, protos: np.ndarray, coefficients: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+        """
+        (N, imgsz, imgsz) binary masks of the detections in the letterboxed input, cropped to their boxes
+        """
+        n_masks, proto_h, proto_w = protos.shape
+        masks = 1 / (1 + np.exp(-(coefficients @ protos.reshape(n_masks, -1))))
+        masks = masks.reshape(-1, proto_h, proto_w)
+
+        # crop at the prototypes resolution as ultralytics does before upsampling
+        scale = np.array([proto_w, proto_h, proto_w, proto_h]) / self.imgsz
+        xyxy = np.concatenate((boxes[:, :2] - boxes[:, 2:] / 2, boxes[:, :2] + boxes[:, 2:] / 2), axis=1) * scale
+        cols, rows = np.arange(proto_w), np.arange(proto_h)
+        inside = ((cols >= xyxy[:, 0, None]) & (cols < xyxy[:, 2, None]))[:, None, :] & \
+                 ((rows >= xyxy[:, 1, None]) & (rows < xyxy[:, 3, None]))[:, :, None]
+        masks *= inside
+
+        return np.stack([cv2.resize(mask, (self.imgsz, self.imgsz), interpolation=cv2.INTER_LINEAR) > 0.5
+                         for mask in masks])
+
+    @staticmethod
+    def mask_to_polygon(mask: np.ndarray, transform: Tuple[float, int, int], shape: Tuple[int, int]) -> np.ndarray:
+        # largest contour of the mask, in the coordinates of the original image
+        contours, _ = cv2.findContours(mask.astype(np.uint8), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if not contours:
+            return np.zeros((0, 2), dtype=np.float32)
+
+        polygon = max(contours, key=len).reshape(-1, 2).astype(np.float32)
+        gain, left, top = transform
+        polygon[:, 0] = ((polygon[:, 0] - left) / gain).clip(0, shape[1])
+        polygon[:, 1] = ((polygon[:, 1] - top) / gain).clip(0, shape[0])
+        return polygon
+
+
+def load_backend(weights: str) -> TorchBackend | OnnxBackend:
+    if config["ModelWrapper"]["backend"] == 'onnx':
+        return OnnxBackend(weights, **config["ModelWrapper"]["Onnx"])
+    return TorchBackend(weights)
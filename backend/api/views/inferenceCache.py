@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import *
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+from api.config import config
+from api.views.boundingBox import BoundingBoxes
+from api.views.diskTier import DiskTier
+
+
+class InferenceResult:
+    """
+    Model outputs of one image: the warped phone (None when no phone was found), its smudges and
+    the cipher guesses already made from them, by layout of the reference
+    """
+
+    def __init__(self, warped: np.ndarray | None, bboxes: BoundingBoxes):
+        self.warped = warped
+        if warped is not None:
+            # shared by the requests of the same image
+            warped.flags.writeable = False
+        self.bboxes = bboxes
+        self.guesses: Dict[Hashable, Tuple[np.ndarray, np.ndarray]] = {}
+
+    @property
+    def nbytes(self) -> int:
+        return (0 if self.warped is None else self.warped.nbytes) + self.bboxes.data.nbytes
+
+
+class InferenceCache:
+    """
+    Content-addressed cache of the model outputs, keyed by a hash of the decoded image and of the models.
+    Least recently used entries are evicted beyond max_bytes in memory. The optional disk tier keeps the
+    model outputs only, shared by the workers and surviving restarts
+    """
+
+    def __init__(self, max_bytes: int, disk_dir: str | None = None, disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.disk = DiskTier(disk_dir, disk_max_bytes, '.npz') if disk_dir else None
+        self.entries: OrderedDict[str, InferenceResult] = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.__model_version = None
+
+    @property
+    def model_version(self) -> str:
+        # any change of the weights or of the inference settings yields other keys
+        if self.__model_version is None:
+            weights = [config["ModelWrapper"]["phone_seg_weights"], config["ModelWrapper"]["smudges_det_weights"]]
+            identity = {
+                'weights': [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) if os.path.exists(path)
+                            else path for path in weights],
+                'settings': {key: config["ModelWrapper"][key] for key in ("backend", "interp_step", "Onnx")},
+                'size': (config["width"], config["height"]),
+            }
+            self.__model_version = hashlib.blake2b(json.dumps(identity).encode(), digest_size=8).hexdigest()
+        return self.__model_version
+
+    def get_key(self, image: np.ndarray) -> str:
+        digest = hashlib.blake2b(np.ascontiguousarray(image).data, digest_size=16)
+        digest.update(str(image.shape).encode())
+        return f"{self.model_version}-{digest.hexdigest()}"
+
+    def get(self, key: str) -> InferenceResult | None:
+        with self.lock:
+            result = self.entries.get(key)
+            if result is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return result
+
+        result = self.load(key)
+        with self.lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.insert(key, result)
+        return result
+
+    def put(self, key: str, result: InferenceResult) -> None:
+        with self.lock:
+            self.insert(key, result)
+        self.save(key, result)
+
+    def insert(self, key: str, result: InferenceResult) -> None:
+        previous = self.entries.pop(key, None)
+        if previous is not None:
+            self.size -= previous.nbytes
+
+        self.entries[key] = result
+        self.size += result.nbytes
+        while self.size > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted.nbytes
+
+    def load(self, key: str) -> InferenceResult | None:
+        if self.disk is None:
+            return None
+
+        try:
+            with np.load(self.disk.get_path(key), allow_pickle=False) as data:
+                warped = data['warped'] if data['has_phone'] else None
+                result = InferenceResult(warped, BoundingBoxes(data['bboxes']))
+            self.disk.touch(key)
+        except (ValueError, KeyError, OSError):
+            # missing, evicted meanwhile or partially written by a crashed worker
+            return None
+
+        return result
+
+    def save(self, key: str, result: InferenceResult) -> None:
+        if self.disk is None:
+            return
+
+        self.disk.write(key, lambda f: np.savez(
+            f,
+            has_phone=result.warped is not None,
+            warped=np.zeros((0,), dtype=np.uint8) if result.warped is None else result.warped,
+            bboxes=result.bboxes.data
+        ))
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {'entries': len(self.entries), 'bytes': self.size, 'hits': self.hits, 'misses': self.misses}
+
+
+inference_cache = InferenceCache(
+    config["InferenceCache"]["max_bytes"],
+    config["InferenceCache"]["disk_dir"],
+    config["InferenceCache"]["disk_max_bytes"]
+) if config["InferenceCache"]["enabled"] else None
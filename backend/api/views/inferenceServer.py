@@ -0,0 +1,140 @@
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client, Connection
+from typing import *
+import hashlib
+import hmac
+import os
+import threading
+
+import numpy as np
+from django.conf import settings
+
+from api.config import config
+from api.views.boundingBox import BoundingBoxes
+from api.views.debugArtefacts import get_artefact_metrics
+from api.views.microBatching import BatchedInference, MicroBatchScheduler
+
+
+def get_authkey() -> bytes:
+    # the connections unpickle what they receive, only the processes knowing the secret key of the
+    # project may connect
+    return hmac.new(settings.SECRET_KEY.encode(), b'inference-server', hashlib.sha256).digest()
+
+
+def encode_results(method: str, results: List[Any]) -> List[Any]:
+    # bounding boxes are sent as their (N, 4) xywh arrays
+    if method == 'detect_smudges':
+        return [bboxes.data for bboxes in results]
+    return results
+
+
+def decode_results(method: str, results: List[Any]) -> List[Any]:
+    if method == 'detect_smudges':
+        return [BoundingBoxes(boxes) for boxes in results]
+    return results
+
+
+class InferenceServer:
+    """
+    Process holding the only copy of the models of the host, shared by all the web workers through a Unix socket.
+    Each connection is served by its own thread, the micro-batching scheduler running the requests
+    of all the connections together
+    """
+
+    def __init__(self, address: str, scheduler: MicroBatchScheduler):
+        self.address = address
+        self.scheduler = scheduler
+
+        # a socket file left by a previous server would prevent binding
+        if os.path.exists(address):
+            os.remove(address)
+
+        # only the user running the web workers may connect, the socket never being reachable by the others
+        umask = os.umask(0o177)
+        try:
+            self.listener = Listener(address, family='AF_UNIX', authkey=get_authkey())
+        finally:
+            os.umask(umask)
+
+    def serve_forever(self) -> None:
+        while True:
+            try:
+                conn = self.listener.accept()
+            except (AuthenticationError, EOFError, ConnectionError) as e:
+                # a process without the key, or gone during the handshake
+                print(f"Inference connection refused: {e!r}")
+                continue
+            threading.Thread(target=self.handle, args=(conn,), name="inference-connection", daemon=True).start()
+
+    def handle(self, conn: Connection) -> None:
+        # the requests of a connection are sequential, one web worker thread holding it at a time
+        with conn:
+            while True:
+                try:
+                    method, images = conn.recv()
+                except (EOFError, OSError):
+                    return
+
+                try:
+                    if method == 'metrics':
+                        metrics = {'micro_batching': self.scheduler.metrics(), 'debug_artefacts': get_artefact_metrics()}
+                        conn.send((True, metrics))
+                    else:
+                        conn.send((True, encode_results(method, self.scheduler.call(method, images))))
+                except Exception as e:
+                    conn.send((False, repr(e)))
+
+
+class RemoteModelWrapper(BatchedInference):
+    """
+    Same inference methods as ModelWrapper, run by the inference server. Each thread of the web
+    worker keeps its own connection
+    """
+
+    def __init__(self, address: str):
+        self.address = address
+        self.local = threading.local()
+
+    def call(self, method: str, images: List[np.ndarray]) -> List[Any]:
+        for attempt in range(2):
+            conn = getattr(self.local, 'conn', None)
+            try:
+                if conn is None:
+                    conn = self.local.conn = Client(self.address, family='AF_UNIX', authkey=get_authkey())
+                conn.send((method, images))
+                ok, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                # the server may have been restarted since the last request
+                self.local.conn = None
+                if attempt == 1:
+                    raise
+
+        if not ok:
+            raise RuntimeError(f"The inference server failed: {result}")
+        return result if method == 'metrics' else decode_results(method, result)
+
+    @staticmethod
+    def warm_up() -> None:
+        # the server warms its models up itself
+        pass
+
+    def metrics(self) -> Dict[str, Any]:
+        return self.call('metrics', [])
+
+
+if __name__ == '__main__':
+    # run from the backend directory: python -m api.views.inferenceServer
+    # the authentication key is derived from the settings of the web workers
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+    from api.views.modelWrapper import ModelWrapper
+
+    model_wrapper = ModelWrapper()
+    model_wrapper.warm_up()
+    scheduler = MicroBatchScheduler(
+        model_wrapper,
+        config["MicroBatching"]["window"],
+        config["MicroBatching"]["max_batch_size"]
+    )
+    print(f"Inference server listening on {config['InferenceServer']['socket']}")
+    InferenceServer(config["InferenceServer"]["socket"], scheduler).serve_forever()
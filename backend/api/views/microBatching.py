@@ -0,0 +1,149 @@
+from abc import ABC, abstractmethod
+from concurrent.futures import Future
+from queue import Queue, Empty
+from typing import *
+import bisect
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from api.views.boundingBox import BoundingBoxes
+
+
+# methods of ModelWrapper taking a list of images, which several requests may share
+BATCHED_METHODS = ('segment_phones', 'detect_smudges')
+
+
+class BatchedInference(ABC):
+    """
+    Inference methods of ModelWrapper implemented by a call(method, images) running the batched ones
+    """
+
+    @abstractmethod
+    def call(self, method: str, images: List[np.ndarray]) -> List[Any]:
+        pass
+
+    def segment_phone(self, image: np.ndarray) -> np.ndarray | None:
+        return self.segment_phones([image])[0]
+
+    def segment_phones(self, images: List[np.ndarray]) -> List[np.ndarray | None]:
+        return self.call('segment_phones', images)
+
+    def detect_smudge(self, image: np.ndarray, filename: LiteralString) -> BoundingBoxes:
+        return self.detect_smudges([image], filename)[0]
+
+    def detect_smudges(self, images: List[np.ndarray], name: LiteralString = 'smudges') -> List[BoundingBoxes]:
+        # the images of several requests are batched together, the debug artefacts are not named after them
+        return self.call('detect_smudges', images)
+
+
+class Histogram:
+    """
+    Cumulative histogram over fixed bucket upper bounds, with the sum and count of the observations
+    """
+
+    def __init__(self, bounds: List[float]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self.lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    def to_json(self) -> Dict[str, Any]:
+        with self.lock:
+            cumulated = np.cumsum(self.counts).tolist()
+            return {
+                'buckets': {**{str(bound): n for bound, n in zip(self.bounds, cumulated)}, '+Inf': cumulated[-1]},
+                'sum': self.sum,
+                'count': self.count,
+            }
+
+
+class MicroBatchScheduler(BatchedInference):
+    """
+    Single consumer of the models: the requests of concurrent threads are collected for up to window seconds
+    after the first one, or until max_batch_size images are pending, then run as one forward pass per method
+    """
+
+    def __init__(self, model_wrapper: Any, window: float, max_batch_size: int):
+        self.model_wrapper = model_wrapper
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self.jobs: Queue[Tuple[str, List[np.ndarray], Future, float]] = Queue()
+
+        self.queue_depth = Histogram([0, 1, 2, 4, 8, 16, 32, 64])
+        self.batch_size = Histogram([1, 2, 4, 8, 16, 32, 64])
+        self.wait_time = Histogram([0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5])
+
+        threading.Thread(target=self.run, name="micro-batching", daemon=True).start()
+
+    def warm_up(self) -> None:
+        self.model_wrapper.warm_up()
+
+    def call(self, method: str, images: List[np.ndarray]) -> List[Any]:
+        if method not in BATCHED_METHODS:
+            raise ValueError(f"Unknown method {method}")
+
+        future = Future()
+        self.jobs.put((method, images, future, time.monotonic()))
+        return future.result()
+
+    def run(self) -> None:
+        while True:
+            jobs = self.collect()
+            self.queue_depth.observe(self.jobs.qsize())
+            for method in BATCHED_METHODS:
+                batch = [job for job in jobs if job[0] == method]
+                if batch:
+                    self.run_batch(method, batch)
+
+    def collect(self) -> List[Tuple[str, List[np.ndarray], Future, float]]:
+        jobs = [self.jobs.get()]
+        deadline = jobs[0][3] + self.window
+        n_images = len(jobs[0][1])
+        while n_images < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                jobs.append(self.jobs.get(timeout=timeout))
+            except Empty:
+                break
+            n_images += len(jobs[-1][1])
+        return jobs
+
+    def run_batch(self, method: str, batch: List[Tuple[str, List[np.ndarray], Future, float]]) -> None:
+        start_time = time.monotonic()
+        for _, _, _, submitted_at in batch:
+            self.wait_time.observe(start_time - submitted_at)
+
+        images = [image for _, job_images, _, _ in batch for image in job_images]
+        self.batch_size.observe(len(images))
+        try:
+            results = getattr(self.model_wrapper, method)(images)
+        except Exception as e:
+            traceback.print_exc()
+            for _, _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for _, job_images, future, _ in batch:
+            future.set_result(results[start:start + len(job_images)])
+            start += len(job_images)
+
+    def metrics(self) -> Dict[str, Any]:
+        return {
+            'queue_depth': self.jobs.qsize(),
+            'queue_depth_histogram': self.queue_depth.to_json(),
+            'batch_size_histogram': self.batch_size.to_json(),
+            'wait_time_seconds_histogram': self.wait_time.to_json(),
+        }
@@ -1,28 +1,58 @@
 from typing import *
+import threading
 
 from scipy.spatial import KDTree
-from ultralytics import YOLO
 import numpy as np
 import cv2
 
 from api.config import config
-from api.views.boundingBox import BoundingBox
+from api.views.boundingBox import BoundingBoxes
+from api.views.debugArtefacts import get_artefact_sink, get_artefact_metrics
+from api.views.inferenceBackends import YoloPrediction, load_backend
+from api.views.inferenceServer import RemoteModelWrapper
+from api.views.microBatching import MicroBatchScheduler
 
 
 class ModelWrapper:
 
     def __init__(self):
-        self.model_phone_segmentation = YOLO(config["ModelWrapper"]["phone_seg_weights"])
-        self.model_smudge_detection = YOLO(config["ModelWrapper"]["smudges_det_weights"])
+        # PyTorch or ONNX Runtime, see the backend of the ModelWrapper config
+        self.model_phone_segmentation = load_backend(config["ModelWrapper"]["phone_seg_weights"])
+        self.model_smudge_detection = load_backend(config["ModelWrapper"]["smudges_det_weights"])
         self.interp_step = config["ModelWrapper"]["interp_step"]
+        self.batch_size = config["ModelWrapper"]["batch_size"]
+        # predictions stay in memory unless the debug artefacts are enabled
+        self.artefacts = get_artefact_sink()
+
+    def warm_up(self) -> None:
+        """
+        Run both models once so that the first request does not pay for the lazy initialisations
+        of the runtimes (weights fusion, memory arenas, kernels selection)
+        """
+        image = np.zeros((config["height"], config["width"], 3), dtype=np.uint8)
+        self.model_phone_segmentation([image])
+        self.model_smudge_detection([image])
 
     def segment_phone(self, image: np.ndarray) -> np.ndarray | None:
-        results = self.model_phone_segmentation(image, save=True)
+        return self.segment_phones([image])[0]
 
-        if results[0].masks is None:
+    def segment_phones(self, images: List[np.ndarray]) -> List[np.ndarray | None]:
+        """
+        Segment and warp the phones of several images with one forward pass per batch
+        """
+        warped = []
+        for start in range(0, len(images), self.batch_size):
+            batch = images[start:start + self.batch_size]
+            results = self.model_phone_segmentation(batch)
+            self.save_artefacts('phone', results)
+            warped.extend(self.warp_phone(image, result) for image, result in zip(batch, results))
+        return warped
+
+    def warp_phone(self, image: np.ndarray, result: YoloPrediction) -> np.ndarray | None:
+        if result.polygons is None:
             return None
 
-        polygon = np.array(results[0].masks.xy[0])
+        polygon = result.polygons[0]
 
         # reduce mask to a quad and refine it
         vertices = self.approx_mask_to_polygon(image, polygon)
@@ -38,12 +68,25 @@ class ModelWrapper:
         image = cv2.warpPerspective(image, matrix, (config["width"], config["height"]))
         return image
 
-    def detect_smudge(self, image: np.ndarray, filename: LiteralString) -> List[BoundingBox]:
-        result = self.model_smudge_detection(image, save=True, name=filename)
-        boxes = result[0].boxes.xywh.numpy()
-        boxes[:, 0] -= (boxes[:, 2] / 2)
-        boxes[:, 1] -= (boxes[:, 3] / 2)
-        return [BoundingBox(box) for box in boxes]
+    def detect_smudge(self, image: np.ndarray, filename: LiteralString) -> BoundingBoxes:
+        return self.detect_smudges([image], filename)[0]
+
+    def detect_smudges(self, images: List[np.ndarray], name: LiteralString = 'smudges') -> List[BoundingBoxes]:
+        """
+        Detect the smudges of several warped phones with one forward pass per batch
+        """
+        bboxes = []
+        for start in range(0, len(images), self.batch_size):
+            results = self.model_smudge_detection(images[start:start + self.batch_size])
+            self.save_artefacts(name, results)
+            for result in results:
+                bboxes.append(BoundingBoxes.from_centers(result.boxes))
+        return bboxes
+
+    def save_artefacts(self, name: str, results: List[YoloPrediction]) -> None:
+        if self.artefacts is not None:
+            for result in results:
+                self.artefacts.submit(name, result)
 
     def interpolate_mask_lines(self, vertices: np.ndarray) -> np.ndarray:
         """
@@ -142,3 +185,53 @@ class ModelWrapper:
         distances_from_top_left = np.linalg.norm(intersects - top_left, axis=1)
         intersects = intersects[np.argsort(distances_from_top_left)]
         return intersects
+
+
+model_wrapper: ModelWrapper | MicroBatchScheduler | RemoteModelWrapper | None = None
+model_wrapper_lock = threading.Lock()
+
+
+def get_model_wrapper() -> ModelWrapper | MicroBatchScheduler | RemoteModelWrapper:
+    """
+    The models are loaded on first use, so that the management commands and the endpoints
+    without inference never load torch or ultralytics.
+    With the inference server, the worker only holds a client of the models of the server
+    """
+    global model_wrapper
+    if model_wrapper is None:
+        with model_wrapper_lock:
+            # another thread may have loaded them in the meantime
+            if model_wrapper is None:
+                if config["InferenceServer"]["enabled"]:
+                    model_wrapper = RemoteModelWrapper(config["InferenceServer"]["socket"])
+                elif config["MicroBatching"]["enabled"]:
+                    model_wrapper = MicroBatchScheduler(
+                        ModelWrapper(),
+                        config["MicroBatching"]["window"],
+                        config["MicroBatching"]["max_batch_size"]
+                    )
+                else:
+                    model_wrapper = ModelWrapper()
+    return model_wrapper
+
+
+def get_inference_metrics() -> Dict[str, Any]:
+    """
+    Metrics of the micro-batching and of the debug artefacts of this worker or of the inference server,
+    None when disabled. The models are never loaded to answer
+    """
+    if config["InferenceServer"]["enabled"]:
+        return get_model_wrapper().metrics()
+
+    if isinstance(model_wrapper, MicroBatchScheduler):
+        micro_batching = model_wrapper.metrics()
+    else:
+        # no inference yet
+        micro_batching = {} if config["MicroBatching"]["enabled"] else None
+    return {'micro_batching': micro_batching, 'debug_artefacts': get_artefact_metrics()}
+
+
+def warm_up() -> None:
+    # hook of the inference workers, see the warm_up option of ModelWrapper in config.yaml
+    if config["ModelWrapper"]["warm_up"]:
+        get_model_wrapper().warm_up()
@@ -1,131 +1,92 @@
-from itertools import permutations, product, combinations
-from functools import reduce
+from itertools import product, combinations
+from math import factorial
 from typing import *
-from collections import defaultdict
-import os
 from typing import List
 
 import numpy as np
 import numpy.typing as npt
 
 from api.config import config
-from utils.cipher_to_literal import ciphers_to_literal
-from utils.generate_stats import StatsBuilder
+from api.views.permutationTemplates import get_permutation_template, get_multiset_template, get_guess_mask
+from api.views.resultCache import ResultCache
+from api.views.statsRegistry import StatsBundle, stats_registry
+from api.views.pinRanking import IndexScorer, MarkovChainScorer, FrequencyScorer, best_first_pins, top_k_rank_sum, \
+    fuse_ranks, upper_bound, BOUND_SLACK
 
 
 class OrderGuessing:
-    __instance = None
+    results_cache = ResultCache(config["ResultCache"]["max_size"], config["ResultCache"]["ttl"])
 
     @staticmethod
-    def get_order_guessing_instance(pin_length: int = 6, should_update: bool = True) -> 'OrderGuessing':
-        if OrderGuessing.__instance is None:
-            OrderGuessing.__instance = OrderGuessing()
+    def get_order_guessing_instance(pin_length: int = config["pin_length"]) -> 'OrderGuessing':
+        return OrderGuessing(stats_registry.get(pin_length))
 
-        if should_update and OrderGuessing.__instance.pin_length != pin_length:
-            OrderGuessing.__instance.update_stats(pin_length)
-            OrderGuessing.__instance.pin_length = pin_length
-
-        return OrderGuessing.__instance
-
-    def __init__(self):
-        self.pin_length = config["pin_length"]
-        pin_length_lit = ciphers_to_literal[self.pin_length]
-        for k, v in config["OrderGuessing"].items():
-            config["OrderGuessing"][k] = v.replace("###", pin_length_lit)
-
-        self.transition_mat = np.load(config["OrderGuessing"]["transition_matrix"], allow_pickle=True)
-        self.prob_by_index = np.load(config["OrderGuessing"]["prob_by_index"], allow_pickle=True)
-        self.freq = np.load(config["OrderGuessing"]["frequencies"], allow_pickle=True)
+    def __init__(self, stats: StatsBundle):
+        # read-only tables shared by all the requests of the same PIN length
+        self.stats = stats
+        self.pin_length = stats.pin_length
+        self.transition_mat = stats.transition_mat
+        self.prob_by_index = stats.prob_by_index
+        self.freq = stats.freq
 
     @staticmethod
     def check_new_pin_length(pin_length: int) -> bool:
-        prev_pin_length = OrderGuessing.get_order_guessing_instance(should_update=False).pin_length
-        if pin_length == prev_pin_length:
-            return True
-
-        prev_pin_length = ciphers_to_literal[prev_pin_length]
-        pin_length_lit = ciphers_to_literal[pin_length]
-        # check if the directory exists
-        for k, v in config["OrderGuessing"].items():
-            config["OrderGuessing"][k] = v.replace(prev_pin_length, pin_length_lit)
-            if not os.path.exists(config["OrderGuessing"][k]):
-                return False
-
-        return True
+        return stats_registry.has_stats(pin_length)
 
     @staticmethod
-    def generate_stats(pin_length: int, file_buffer: BinaryIO) -> None:
-        try:
-            sb = StatsBuilder(file_buffer=file_buffer, expected_pin_len=pin_length)
-            sb.save_stats()
-        except ValueError as e:
-            raise e
-
-    def update_stats(self, _pin_length: int) -> None:
-        pin_length_lit = ciphers_to_literal[_pin_length]
-        for k, v in config["OrderGuessing"].items():
-            config["OrderGuessing"][k] = v.replace("###", pin_length_lit)
-
-        try:
-            self.transition_mat = np.load(config["OrderGuessing"]["transition_matrix"], allow_pickle=True)
-            self.prob_by_index = np.load(config["OrderGuessing"]["prob_by_index"], allow_pickle=True)
-            self.freq = np.load(config["OrderGuessing"]["frequencies"], allow_pickle=True)
-        except FileNotFoundError:
-            raise FileNotFoundError("The stats file does not exist. Please generate it first.")
+    def on_stats_published(pin_length: int) -> None:
+        # the other workers notice the new build through the registry version
+        stats_registry.invalidate(pin_length)
+        OrderGuessing.results_cache.invalidate(lambda key: key[1] == pin_length)
 
     @staticmethod
     def reduce_permutations_by_guess(
             ciphers: npt.NDArray[int],
             ordered_cipher_guesses: List[str]
     ) -> npt.NDArray[npt.NDArray[int]]:
-
-        all_pins_sep_tmp = np.array(list(permutations(ciphers)))
-        guess_indexes = [i for i, val in enumerate(ordered_cipher_guesses) if val != '']
-
-        if not guess_indexes:
-            return all_pins_sep_tmp
-
-        ordered_guesses = np.array([int(val) if val != '' else -1 for val in ordered_cipher_guesses])
-        mask = np.ones(len(all_pins_sep_tmp), dtype=bool)
-
-        for i in guess_indexes:
-            mask &= (all_pins_sep_tmp[:, i] == ordered_guesses[i])
-
-        return all_pins_sep_tmp[mask]
+        """
+        Distinct permutations of the ciphers, in lexicographic order, that respect the positional guesses.
+        The permutation patterns and the guess masks are cached, only the ciphers are indexed here
+        """
+        values, counts = np.unique(ciphers, return_counts=True)
+        counts = tuple(counts.tolist())
+        value_indexes = {int(value): i for i, value in enumerate(values)}
+        guesses = tuple(None if val == '' else value_indexes.get(int(val), -1) for val in ordered_cipher_guesses)
+
+        template = get_multiset_template(counts)
+        mask = get_guess_mask(counts, guesses)
+        return values[template] if mask is None else values[template[mask]]
 
     def compute_prob_by_index(
             self,
             all_pins_sep: npt.NDArray[npt.NDArray[int]]
-    ) -> npt.NDArray[int]:
+    ) -> npt.NDArray[float]:
 
-        prob_acc_index = np.prod(self.prob_by_index[all_pins_sep, np.arange(all_pins_sep.shape[1])], axis=1)
-        sorted_pins_acc_index = np.argsort(prob_acc_index)[::-1]
-        return sorted_pins_acc_index
+        prob_acc_index = np.prod(self.prob_by_index[all_pins_sep, np.arange(all_pins_sep.shape[-1])], axis=-1)
+        return prob_acc_index
 
     def compute_prob_by_markov_chain(
             self,
             all_pins_sep: npt.NDArray[npt.NDArray[int]]
-    ) -> npt.NDArray[int]:
+    ) -> npt.NDArray[float]:
 
-        prob_acc_markov = np.prod(self.transition_mat[all_pins_sep[:, :-1], all_pins_sep[:, 1:]], axis=1)
-        sorted_pins_acc_markov = np.argsort(prob_acc_markov)[::-1]
-        return sorted_pins_acc_markov
+        prob_acc_markov = np.prod(self.transition_mat[all_pins_sep[..., :-1], all_pins_sep[..., 1:]], axis=-1)
+        return prob_acc_markov
 
     def compute_prob_by_frequency(
             self,
             all_pins: npt.NDArray[int]
-    ) -> npt.NDArray[int]:
+    ) -> npt.NDArray[float]:
 
         prob_acc_freq = self.freq[all_pins]
-        sorted_pins_acc_freq = np.argsort(prob_acc_freq)[::-1]
-        return sorted_pins_acc_freq
+        return prob_acc_freq
 
     def compute_all_probs(
             self,
             cipher_guessing_algorithms: List[str],
             all_pins_sep: npt.NDArray[npt.NDArray[int]],
             all_pins: npt.NDArray[int]
-    ) -> List[npt.NDArray[int]]:
+    ) -> List[npt.NDArray[float]]:
 
         algorithms_probs = []
         if 'index' in cipher_guessing_algorithms:
@@ -139,6 +100,171 @@ class OrderGuessing:
 
         return algorithms_probs
 
+    def get_scorers(
+            self,
+            cipher_guessing_algorithms: List[str]
+    ) -> List[IndexScorer | MarkovChainScorer | FrequencyScorer]:
+
+        # same order as compute_all_probs as it breaks the ties of the rank fusion
+        scorers = []
+        if 'index' in cipher_guessing_algorithms:
+            scorers.append(IndexScorer(self.prob_by_index))
+
+        if 'markov_chain' in cipher_guessing_algorithms:
+            scorers.append(MarkovChainScorer(self.transition_mat))
+
+        if 'frequency' in cipher_guessing_algorithms:
+            scorers.append(FrequencyScorer(self.freq, self.stats.freq_prefix_max))
+
+        return scorers
+
+    def search_most_probable_pins(
+            self,
+            ciphers: npt.NDArray[int],
+            cipher_guessing_algorithms: List[str],
+            order_cipher_guesses: List[str]
+    ) -> list[list[str | float]]:
+        """
+        Top-k rank fusion without enumerating the permutations: each algorithm lazily ranks
+        the PIN codes with a best-first search and the fusion stops reading as soon as the
+        k best rank sums are certain
+        """
+        guesses = [int(val) if val != '' else None for val in order_cipher_guesses]
+        streams = [best_first_pins(scorer, ciphers, guesses) for scorer in self.get_scorers(cipher_guessing_algorithms)]
+        most_probable_pins = top_k_rank_sum(streams, config['n_more_probable_pins'])
+
+        return [[''.join(str(cipher) for cipher in pin), float(np.mean(scores))]
+                for pin, scores in most_probable_pins]
+
+    def enumerate_most_probable_pins(
+            self,
+            ciphers: npt.NDArray[int],
+            cipher_guessing_algorithms: List[str],
+            order_cipher_guesses: List[str]
+    ) -> list[list[str | float]]:
+        """
+        Exhaustive rank fusion of all the distinct permutations of the ciphers, vectorised
+        """
+        all_pins_sep = self.reduce_permutations_by_guess(ciphers, order_cipher_guesses)
+        all_pins = all_pins_sep @ (10 ** np.arange(self.pin_length - 1, -1, -1))
+
+        if not cipher_guessing_algorithms or len(all_pins) == 0:
+            return []
+
+        algorithms_probs = self.compute_all_probs(cipher_guessing_algorithms, all_pins_sep, all_pins)
+        best_pins, fused_probs = fuse_ranks(np.array(algorithms_probs), config['n_more_probable_pins'])
+
+        return [[str(pin).zfill(self.pin_length), float(prob)] for pin, prob in zip(all_pins[best_pins], fused_probs)]
+
+    def score_sequences(
+            self,
+            sequences: npt.NDArray[npt.NDArray[int]],
+            cipher_guessing_algorithms: List[str],
+            order_cipher_guesses: List[str]
+    ) -> Tuple[npt.NDArray[int], npt.NDArray[float]]:
+        """
+        Score the permutations of several cipher sets at once by applying a shared permutation template.
+        Return the (n_sequences, n_permutations) PIN codes sorted by increasing value and the
+        (n_sequences, n_algorithms, n_permutations) probabilities, set to -inf for the duplicated PIN
+        codes and for the ones contradicting the guesses
+        """
+        n = sequences.shape[1]
+        all_pins_sep = sequences[:, get_permutation_template(n)]
+        all_pins = all_pins_sep @ (10 ** np.arange(n - 1, -1, -1))
+
+        order = np.argsort(all_pins, axis=1, kind='stable')
+        all_pins = np.take_along_axis(all_pins, order, axis=1)
+        all_pins_sep = np.take_along_axis(all_pins_sep, order[..., None], axis=1)
+
+        valid = np.ones(all_pins.shape, dtype=bool)
+        valid[:, 1:] = all_pins[:, 1:] != all_pins[:, :-1]
+        for i, val in enumerate(order_cipher_guesses):
+            if val != '':
+                valid &= (all_pins_sep[..., i] == int(val))
+
+        algorithms_probs = np.stack(self.compute_all_probs(cipher_guessing_algorithms, all_pins_sep, all_pins), axis=1)
+        return all_pins, np.where(valid[:, None, :], algorithms_probs, -np.inf)
+
+    def process_batch(
+            self,
+            sequences: npt.NDArray[npt.NDArray[int]],
+            cipher_guessing_algorithms: List[str],
+            order_cipher_guesses: List[str]
+    ) -> List[str]:
+        """
+        Evaluate all the candidate cipher sets in vectorised chunks and return the most probable PIN codes
+        of the one whose mean fused probability is the highest (the first one in case of equality).
+        Cipher sets whose best fused probability cannot beat the current best mean are not fused.
+        """
+        k = config['n_more_probable_pins']
+        chunk_size = max(1, config['ranking_batch_size'] // factorial(self.pin_length))
+
+        best_mean, best_index, best_pins = 0, None, []
+        for start in range(0, len(sequences), chunk_size):
+            all_pins, algorithms_probs = self.score_sequences(
+                sequences[start:start + chunk_size], cipher_guessing_algorithms, order_cipher_guesses
+            )
+            indexes = start + np.arange(len(all_pins))
+
+            # the mean of the k best fused probabilities cannot exceed the best fused probability
+            upper_bounds = algorithms_probs.mean(axis=1).max(axis=1) * BOUND_SLACK
+
+            # the most promising cipher set is fused first so that its mean prunes the others
+            leader = np.argmax(upper_bounds)
+            for selection in (np.array([leader]), np.delete(np.arange(len(indexes)), leader)):
+                could_beat = upper_bounds[selection] > best_mean
+                if best_index is not None:
+                    could_beat |= (upper_bounds[selection] == best_mean) & (indexes[selection] < best_index)
+
+                selection = selection[could_beat]
+                if len(selection) == 0:
+                    continue
+
+                best, fused_probs = fuse_ranks(algorithms_probs[selection], k)
+                found = np.isfinite(fused_probs)
+                means = np.where(found, fused_probs, 0).sum(axis=1) / np.maximum(found.sum(axis=1), 1)
+                means[~found.any(axis=1)] = -np.inf
+
+                for row, i in enumerate(selection):
+                    if means[row] > best_mean or (best_index is not None and means[row] == best_mean and
+                                                  indexes[i] < best_index):
+                        best_mean, best_index = means[row], indexes[i]
+                        best_pins = [str(pin).zfill(self.pin_length) for pin in all_pins[i, best[row][found[row]]]]
+
+        return best_pins
+
+    def search_best_sequence(
+            self,
+            sequences: npt.NDArray[npt.NDArray[int]],
+            cipher_guessing_algorithms: List[str],
+            order_cipher_guesses: List[str]
+    ) -> List[str]:
+        """
+        Same as process_batch when the permutations are too many to be enumerated: the cipher sets are searched
+        by decreasing upper bound of their fused probability until none of them can beat the best mean
+        """
+        guesses = [int(val) if val != '' else None for val in order_cipher_guesses]
+        scorers = self.get_scorers(cipher_guessing_algorithms)
+        upper_bounds = [np.mean([upper_bound(scorer, sequence, guesses) for scorer in scorers])
+                        for sequence in sequences]
+
+        best_mean, best_index, best_pins = 0, None, []
+        for i in np.argsort(upper_bounds, kind='stable')[::-1]:
+            if upper_bounds[i] < best_mean:
+                break
+            if upper_bounds[i] == best_mean and best_index is not None and i > best_index:
+                continue
+
+            result = self.search_most_probable_pins(sequences[i], cipher_guessing_algorithms, order_cipher_guesses)
+            if not result:
+                continue
+
+            mean = np.mean([prob for _, prob in result])
+            if mean > best_mean or (best_index is not None and mean == best_mean and i < best_index):
+                best_mean, best_index, best_pins = mean, i, [pin for pin, _ in result]
+
+        return best_pins
+
     @staticmethod
     def process(
             ciphers: npt.NDArray[int],
@@ -146,27 +272,38 @@ class OrderGuessing:
             order_cipher_guesses: List[str]
     ) -> list[list[str | float]]:
 
-        og = OrderGuessing.get_order_guessing_instance(len(ciphers), should_update=True)
-        all_pins_sep = og.reduce_permutations_by_guess(ciphers, order_cipher_guesses)
-        all_pins = np.array([reduce(lambda x, y: 10 * x + y, pin) for pin in all_pins_sep])
-        all_pins_sep = np.array(all_pins_sep)
-        n_permutations = len(all_pins)
-
+        og = OrderGuessing.get_order_guessing_instance(len(ciphers))
         order_guessing_algorithms = [k for k, v in order_guessing_algorithms.items() if v]
-        algorithms_probs = og.compute_all_probs(order_guessing_algorithms, all_pins_sep, all_pins)
-        weights = defaultdict(int)
-        pseudo_probs = defaultdict(float)
-        for rank in range(n_permutations):
-            for i in range(len(algorithms_probs)):
-                weights[all_pins[algorithms_probs[i][rank]]] += rank
-                pseudo_probs[all_pins[algorithms_probs[i][rank]]] += algorithms_probs[i][rank]
 
-        sorted_weights = sorted(weights.items(), key=lambda item: item[1])
-        nth_best_weights = sorted_weights[: min(config['n_more_probable_pins'], n_permutations)]
+        # the search only pays off when the permutations do not fit in memory
+        if factorial(len(ciphers)) > config['ranking_search_threshold']:
+            return og.search_most_probable_pins(ciphers, order_guessing_algorithms, order_cipher_guesses)
 
-        result = [[pin_code, pseudo_probs[pin_code]] for pin_code, _ in nth_best_weights]
+        return og.enumerate_most_probable_pins(ciphers, order_guessing_algorithms, order_cipher_guesses)
 
-        return [[str(pin).zfill(og.pin_length), pseudo_probs[pin]] for pin, pseudo_prob in result]
+    @staticmethod
+    def process_cached(
+            ciphers: npt.NDArray[int],
+            order_guessing_algorithms: Dict[str, bool],
+            order_cipher_guesses: List[str]
+    ) -> list[list[str | float]]:
+        """
+        Same as process but the results are cached, the order of the ciphers being irrelevant
+        """
+        key = (
+            tuple(sorted(int(cipher) for cipher in ciphers)),
+            len(ciphers),
+            tuple(sorted(k for k, v in order_guessing_algorithms.items() if v)),
+            tuple(order_cipher_guesses),
+            stats_registry.get_version(len(ciphers))
+        )
+
+        result = OrderGuessing.results_cache.get(key)
+        if result is None:
+            result = OrderGuessing.process(ciphers, order_guessing_algorithms, order_cipher_guesses)
+            OrderGuessing.results_cache.put(key, result)
+
+        return result
 
     @staticmethod
     def case_handler(
@@ -206,16 +343,18 @@ class OrderGuessing:
         else:
             new_sequences = np.array([ciphers])
 
-        best_mean = 0
-        best_sequences = []
-        for i, sequence in enumerate(new_sequences):
-            result = OrderGuessing.process(sequence, order_guessing_algorithms, order_cipher_guesses)
-            mean = np.mean([float(prob) for _, prob in result])
-            if mean > best_mean:
-                best_mean = mean
-                best_sequences = [ciphers for ciphers, _ in result]
+        if len(new_sequences) == 0:
+            return []
+
+        og = OrderGuessing.get_order_guessing_instance(expected_length)
+        order_guessing_algorithms = [k for k, v in order_guessing_algorithms.items() if v]
+        if not order_guessing_algorithms:
+            return []
+
+        if factorial(expected_length) > config['ranking_search_threshold']:
+            return og.search_best_sequence(new_sequences, order_guessing_algorithms, order_cipher_guesses)
 
-        return best_sequences
+        return og.process_batch(new_sequences, order_guessing_algorithms, order_cipher_guesses)
 
 
 # use reflection to get the name of the computation methods that start with the following prefix
@@ -0,0 +1,77 @@
+from functools import lru_cache
+from typing import *
+import os
+import threading
+
+import numpy as np
+import numpy.typing as npt
+
+from api.config import config
+
+
+def build_permutation_template(n: int) -> npt.NDArray[np.int8]:
+    """
+    All the permutations of range(n) in lexicographic order: the permutations of
+    size s are the ones of size s - 1 prefixed by each first index, the other indexes being shifted
+    """
+    template = np.zeros((1, 0), dtype=np.int8)
+    for size in range(1, n + 1):
+        firsts = np.repeat(np.arange(size, dtype=np.int8), len(template))
+        rest = np.tile(template, (size, 1))
+        rest += (rest >= firsts[:, None])
+        template = np.column_stack((firsts, rest))
+
+    return template
+
+
+@lru_cache(maxsize=None)
+def get_permutation_template(n: int) -> npt.NDArray[np.int8]:
+    """
+    (n!, n) permutation index template, built once per length and memory-mapped from disk
+    """
+    path = os.path.join(config["permutation_templates_dir"], f"permutations_{n}.npy")
+    if not os.path.exists(path):
+        os.makedirs(config["permutation_templates_dir"], exist_ok=True)
+        # write aside and rename to never expose a partial file to the other workers,
+        # nor share the file with another thread building the same template
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, build_permutation_template(n))
+        os.replace(tmp_path, path)
+
+    return np.load(path, mmap_mode='r')
+
+
+@lru_cache(maxsize=128)
+def get_multiset_template(counts: Tuple[int, ...]) -> npt.NDArray[np.int8]:
+    """
+    Distinct permutations of a multiset given by the multiplicities of its sorted values, as indexes
+    of the values in lexicographic order. Repeated values would otherwise yield prod(k!) copies of each row
+    """
+    template = get_permutation_template(sum(counts))
+    if all(count == 1 for count in counts):
+        return template
+
+    value_indexes = np.repeat(np.arange(len(counts), dtype=np.int8), counts)
+    template = np.unique(value_indexes[template], axis=0)
+    template.flags.writeable = False
+    return template
+
+
+@lru_cache(maxsize=1024)
+def get_guess_mask(counts: Tuple[int, ...], guesses: Tuple[int | None, ...]) -> npt.NDArray[bool] | None:
+    """
+    Rows of the multiset template matching the positional guesses, given as value indexes (-1 when the
+    guessed cipher is not among the values). None when there is no guess
+    """
+    if all(guess is None for guess in guesses):
+        return None
+
+    template = get_multiset_template(counts)
+    mask = np.ones(len(template), dtype=bool)
+    for i, guess in enumerate(guesses):
+        if guess is not None:
+            mask &= (template[:, i] == guess)
+
+    mask.flags.writeable = False
+    return mask
@@ -0,0 +1,267 @@
+from heapq import heappush, heappop, nsmallest
+from typing import *
+
+import numpy as np
+import numpy.typing as npt
+
+
+# bounds are slightly inflated so that floating point rounding can never make them inadmissible
+BOUND_SLACK = 1 + 1e-9
+
+
+class IndexScorer:
+    """
+    Product of the probabilities of each cipher at its position
+    """
+
+    def __init__(self, prob_by_index: npt.NDArray[float]):
+        self.prob_by_index = prob_by_index.tolist()
+        # ciphers sorted by decreasing probability for each index
+        self.best_by_index = [[(float(prob_by_index[c, index]), int(c)) for c in np.argsort(-prob_by_index[:, index])]
+                              for index in range(prob_by_index.shape[1])]
+
+    @staticmethod
+    def start() -> float:
+        return 1.0
+
+    def step(self, acc: float, prefix: Tuple[int, ...], cipher: int) -> float:
+        return acc * self.prob_by_index[cipher][len(prefix)]
+
+    def bound(self, acc: float, prefix: Tuple[int, ...], remaining: List[int], guesses: List[int | None]) -> float:
+        # each free index takes at best the most probable remaining cipher
+        for index in range(len(prefix), len(guesses)):
+            if guesses[index] is not None:
+                acc *= self.prob_by_index[guesses[index]][index]
+                continue
+
+            for prob, cipher in self.best_by_index[index]:
+                if remaining[cipher] > 0:
+                    acc *= prob
+                    break
+        return acc
+
+    @staticmethod
+    def score(acc: float) -> float:
+        return acc
+
+
+class MarkovChainScorer:
+    """
+    Product of the transition probabilities between consecutive ciphers
+    """
+
+    def __init__(self, transition_mat: npt.NDArray[float]):
+        self.transition_mat = transition_mat.tolist()
+
+    @staticmethod
+    def start() -> float:
+        return 1.0
+
+    def step(self, acc: float, prefix: Tuple[int, ...], cipher: int) -> float:
+        if not prefix:
+            return acc
+        return acc * self.transition_mat[prefix[-1]][cipher]
+
+    def bound(self, acc: float, prefix: Tuple[int, ...], remaining: List[int], guesses: List[int | None]) -> float:
+        # every remaining cipher is entered exactly once, either from the last placed
+        # cipher or from another remaining one, except the first cipher of the PIN code
+        best_in = []
+        for cipher in range(10):
+            if remaining[cipher] == 0:
+                continue
+
+            best = self.transition_mat[prefix[-1]][cipher] if prefix else 0.0
+            for pred in range(10):
+                n_pred = remaining[pred] - (pred == cipher)
+                if n_pred > 0 and self.transition_mat[pred][cipher] > best:
+                    best = self.transition_mat[pred][cipher]
+
+            best_in.extend([best] * remaining[cipher])
+
+        if not prefix and best_in:
+            best_in.remove(min(best_in))
+
+        for best in best_in:
+            acc *= best
+        return acc
+
+    @staticmethod
+    def score(acc: float) -> float:
+        return acc
+
+
+class FrequencyScorer:
+    """
+    Frequency of the whole PIN code, the accumulator being the integer value of the prefix
+    """
+
+    def __init__(self, freq: npt.NDArray[float], prefix_max: List[npt.NDArray[float]]):
+        self.freq = freq
+        self.prefix_max = prefix_max
+
+    @staticmethod
+    def build_prefix_max(freq: npt.NDArray[float], pin_length: int) -> List[npt.NDArray[float]]:
+        """
+        prefix_max[l][p] is the highest frequency among all PIN codes starting with the l-digits prefix p
+        """
+        prefix_max = [freq]
+        for length in range(pin_length - 1, -1, -1):
+            prefix_max.insert(0, prefix_max[0].reshape(10 ** length, 10).max(axis=1))
+        return prefix_max
+
+    @staticmethod
+    def start() -> int:
+        return 0
+
+    @staticmethod
+    def step(acc: int, prefix: Tuple[int, ...], cipher: int) -> int:
+        return 10 * acc + cipher
+
+    def bound(self, acc: int, prefix: Tuple[int, ...], remaining: List[int], guesses: List[int | None]) -> float:
+        return float(self.prefix_max[len(prefix)][acc])
+
+    def score(self, acc: int) -> float:
+        return float(self.freq[acc])
+
+
+def upper_bound(
+        scorer: IndexScorer | MarkovChainScorer | FrequencyScorer,
+        ciphers: npt.NDArray[int],
+        guesses: List[int | None]
+) -> float:
+    """
+    Upper bound of the score of any permutation of the ciphers
+    """
+    counts = [0] * 10
+    for cipher in ciphers:
+        counts[int(cipher)] += 1
+
+    return scorer.bound(scorer.start(), (), counts, guesses) * BOUND_SLACK
+
+
+def best_first_pins(
+        scorer: IndexScorer | MarkovChainScorer | FrequencyScorer,
+        ciphers: npt.NDArray[int],
+        guesses: List[int | None]
+) -> Iterator[Tuple[Tuple[int, ...], float]]:
+    """
+    Lazily yield the distinct permutations of the ciphers by decreasing score (ties by increasing PIN)
+    using a best-first search over the prefixes guided by the admissible bound of the scorer
+    """
+    n = len(ciphers)
+    counts = [0] * 10
+    for cipher in ciphers:
+        counts[int(cipher)] += 1
+
+    acc = scorer.start()
+    heap = [(-scorer.bound(acc, (), counts, guesses) * BOUND_SLACK, (), acc, counts)]
+    while heap:
+        _, prefix, acc, remaining = heappop(heap)
+        if len(prefix) == n:
+            yield prefix, scorer.score(acc)
+            continue
+
+        index = len(prefix)
+        candidates = range(10) if guesses[index] is None else [guesses[index]]
+        for cipher in candidates:
+            if remaining[cipher] == 0:
+                continue
+
+            new_remaining = remaining.copy()
+            new_remaining[cipher] -= 1
+            new_acc = scorer.step(acc, prefix, cipher)
+            new_prefix = prefix + (cipher,)
+            if len(new_prefix) == n:
+                priority = scorer.score(new_acc)
+            else:
+                priority = scorer.bound(new_acc, new_prefix, new_remaining, guesses) * BOUND_SLACK
+
+            heappush(heap, (-priority, new_prefix, new_acc, new_remaining))
+
+
+def top_k_rank_sum(
+        streams: List[Iterator[Tuple[Tuple[int, ...], float]]],
+        k: int
+) -> List[Tuple[Tuple[int, ...], List[float]]]:
+    """
+    Rank-sum fusion of several ranked streams of the same candidates, reading them only as deep as
+    needed to guarantee the k best (no random access algorithm).
+
+    Ties on the rank sum are broken as in the exhaustive fusion: by the first (rank, stream) where a
+    candidate appears
+    """
+    m = len(streams)
+    if m == 0 or k <= 0:
+        return []
+
+    ranks: Dict[Tuple[int, ...], List[int | None]] = {}
+    scores: Dict[Tuple[int, ...], List[float | None]] = {}
+    first_seen: Dict[Tuple[int, ...], int] = {}
+    complete: Dict[Tuple[int, ...], int] = {}
+    depth = 0
+    exhausted = False
+    while not exhausted:
+        for i, stream in enumerate(streams):
+            item = next(stream, None)
+            if item is None:
+                # all the streams hold the same candidates and thus end together
+                exhausted = True
+                continue
+
+            pin, score = item
+            if pin not in ranks:
+                ranks[pin] = [None] * m
+                scores[pin] = [None] * m
+                first_seen[pin] = len(first_seen)
+
+            ranks[pin][i] = depth
+            scores[pin][i] = score
+            if all(rank is not None for rank in ranks[pin]):
+                complete[pin] = sum(ranks[pin])
+
+        depth += 1
+        if exhausted or len(complete) < k:
+            continue
+
+        # k-th best candidate among the ones whose rank sum is known
+        kth_sum, kth_seen = max((complete[pin], first_seen[pin]) for pin in
+                                nsmallest(k, complete, key=lambda p: (complete[p], first_seen[p])))
+
+        # never seen candidates have a rank of at least depth in every stream and appear later
+        if m * depth < kth_sum:
+            continue
+
+        # partially seen candidates have a rank of at least depth in the streams where they are missing
+        if all((sum(r for r in pin_ranks if r is not None) + depth * pin_ranks.count(None), first_seen[pin]) >
+               (kth_sum, kth_seen) for pin, pin_ranks in ranks.items() if pin not in complete):
+            break
+
+    best = nsmallest(k, complete, key=lambda p: (complete[p], first_seen[p]))
+    return [(pin, scores[pin]) for pin in best]
+
+
+def fuse_ranks(
+        algorithms_probs: npt.NDArray[float],
+        k: int
+) -> Tuple[npt.NDArray[int], npt.NDArray[float]]:
+    """
+    Exhaustive rank-sum fusion of the (..., n_algorithms, n_candidates) probabilities, leading axes
+    being independent batches of candidates.
+    Return the indexes of the k best candidates and their fused probability (mean over the algorithms)
+    """
+    m, n = algorithms_probs.shape[-2:]
+    k = min(k, n)
+
+    # rank of each candidate for each algorithm by scattering the inverse permutation of the sort
+    order = np.argsort(-algorithms_probs, axis=-1, kind='stable')
+    ranks = np.empty_like(order)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(n), order.shape), axis=-1)
+    rank_sums = ranks.sum(axis=-2)
+
+    # ties are broken by the first (rank, algorithm) where a candidate appears, which is unique
+    first_seen = (ranks * m + np.arange(m)[:, None]).min(axis=-2)
+    keys = rank_sums * (m * n) + first_seen
+
+    best = np.argpartition(keys, k - 1, axis=-1)[..., :k]
+    best = np.take_along_axis(best, np.argsort(np.take_along_axis(keys, best, axis=-1), axis=-1), axis=-1)
+    return best, np.take_along_axis(algorithms_probs.mean(axis=-2), best, axis=-1)
@@ -0,0 +1,161 @@
+from datetime import datetime
+from typing import *
+import threading
+import time
+
+import numpy as np
+from django.db import transaction, DatabaseError
+from django.db.models import F
+from django.utils import timezone
+
+from api.config import config
+from api.models import ReferenceModel, BoundingBoxModel, LayoutVersionModel
+
+
+class ReferenceLayouts:
+    """
+    In-process copy of the keypad layouts of the references, as read-only (N, 5) arrays of [cipher, x, y, w, h]
+    rows ordered by cipher. Every change bumps a version counter in the database, checked at most every
+    check_interval seconds, so that the other workers drop their copies too.
+    The layouts are saved as one JSON column of the reference in the compact storage
+    """
+
+    def __init__(self, check_interval: float, compact: bool):
+        self.check_interval = check_interval
+        self.compact = compact
+        self.layouts: Dict[str, np.ndarray] = {}
+        self.version = None
+        self.checked_at = -np.inf
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_db_version() -> int:
+        return LayoutVersionModel.objects.filter(pk=1).values_list('version', flat=True).first() or 0
+
+    @staticmethod
+    def get_db_state() -> Tuple[int, datetime | None]:
+        # version and time of the last change of the layouts
+        return LayoutVersionModel.objects.filter(pk=1).values_list('version', 'updated_at').first() or (0, None)
+
+    @staticmethod
+    def to_layout(rows: List[Tuple[int, int, int, int, int]] | List[List[int]]) -> np.ndarray:
+        layout = np.array(rows, dtype=np.int64).reshape(-1, 5)
+        layout.flags.writeable = False
+        return layout
+
+    def check_version(self) -> int:
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return self.version
+
+        version = self.get_db_version()
+        with self.lock:
+            self.checked_at = now
+            if version != self.version:
+                self.layouts = {}
+                self.version = version
+        return version
+
+    def get(self, reference: str) -> np.ndarray:
+        version = self.check_version()
+        layout = self.layouts.get(reference)
+        if layout is not None:
+            return layout
+
+        rows = list(BoundingBoxModel.objects.filter(ref__ref=reference).order_by('cipher')
+                    .values_list('cipher', 'x', 'y', 'w', 'h'))
+        if not rows:
+            # compact storage, raises for unknown references
+            compact_layout = ReferenceModel.objects.values_list('layout', flat=True).get(ref=reference) or []
+            rows = [[cipher, *bbox] for cipher, bbox in enumerate(compact_layout)]
+
+        layout = self.to_layout(rows)
+        with self.lock:
+            # not kept if the layouts were changed meanwhile
+            if self.version == version:
+                self.layouts[reference] = layout
+        return layout
+
+    def load_all(self) -> None:
+        """
+        Load the layouts of all the references at once
+        """
+        version = self.get_db_version()
+        rows = BoundingBoxModel.objects.order_by('ref__ref', 'cipher').values_list('ref__ref', 'cipher', 'x', 'y', 'w', 'h')
+
+        by_reference = {}
+        for reference, *row in rows:
+            by_reference.setdefault(reference, []).append(row)
+        for reference, compact_layout in ReferenceModel.objects.filter(layout__isnull=False).values_list('ref', 'layout'):
+            by_reference[reference] = [[cipher, *bbox] for cipher, bbox in enumerate(compact_layout)]
+
+        with self.lock:
+            self.layouts = {reference: self.to_layout(layout) for reference, layout in by_reference.items()}
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def save(self, reference: ReferenceModel, bboxes: List[List[int]]) -> None:
+        """
+        Replace the [x, y, w, h] boxes by cipher of a reference, created if not saved yet,
+        with bulk queries in a single transaction
+        """
+        is_new = reference.pk is None
+        layout = bboxes if self.compact else None
+
+        with transaction.atomic():
+            if is_new or reference.layout != layout:
+                reference.layout = layout
+                reference.save()
+
+            if self.compact:
+                if not is_new:
+                    BoundingBoxModel.objects.filter(ref=reference).delete()
+            else:
+                # the rows of the ciphers already saved are updated in place
+                rows = {} if is_new else {bb.cipher: bb for bb in BoundingBoxModel.objects.filter(ref=reference)}
+                to_update, to_create = [], []
+                for cipher, (x, y, w, h) in enumerate(bboxes):
+                    bb = rows.pop(cipher, None)
+                    if bb is None:
+                        to_create.append(BoundingBoxModel(ref=reference, cipher=cipher, x=x, y=y, w=w, h=h))
+                    else:
+                        bb.x, bb.y, bb.w, bb.h = x, y, w, h
+                        to_update.append(bb)
+
+                BoundingBoxModel.objects.bulk_update(to_update, ['x', 'y', 'w', 'h'])
+                BoundingBoxModel.objects.bulk_create(to_create)
+                if rows:
+                    BoundingBoxModel.objects.filter(id__in=[bb.id for bb in rows.values()]).delete()
+
+            self.invalidate()
+
+    def invalidate(self) -> None:
+        """
+        To be called after each change of the references, in this worker and, through the version, in the others.
+        The local copies are dropped once the change is committed
+        """
+        # part of the transaction of the change, if any
+        with transaction.atomic(savepoint=False):
+            if not LayoutVersionModel.objects.filter(pk=1).update(version=F('version') + 1, updated_at=timezone.now()):
+                LayoutVersionModel.objects.get_or_create(pk=1, defaults={'version': 1})
+            transaction.on_commit(self.clear)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.layouts = {}
+            self.version = None
+            self.checked_at = -np.inf
+
+
+reference_layouts = ReferenceLayouts(
+    config["ReferenceLayouts"]["check_interval"],
+    config["ReferenceLayouts"]["compact"]
+)
+
+
+def warm_up() -> None:
+    # hook of the server workers, the database may not be migrated yet
+    try:
+        reference_layouts.load_all()
+    except DatabaseError as e:
+        print(f"Reference layouts not loaded: {e!r}")
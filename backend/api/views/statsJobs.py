@@ -0,0 +1,183 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from typing import *
+import os
+import shutil
+import threading
+import time
+import traceback
+
+from django.core.files.uploadedfile import UploadedFile
+from django.db import close_old_connections, connection, DatabaseError
+from django.utils import timezone
+
+from api.config import config
+from api.models import StatsJobModel
+from api.views.orderGuessing import OrderGuessing
+from utils.cipher_to_literal import ciphers_to_literal
+from utils.generate_stats import StatsBuilder
+
+
+class StatsJobs:
+    """
+    Statistics builds run in background threads of the web worker, the jobs being tracked in the
+    database so that any worker can report their progress. The build itself is sharded over a process pool.
+    The worker keeps the jobs it holds alive with a heartbeat, the ones left by a stopped worker being failed
+    """
+    UNFINISHED = [StatsJobModel.PENDING, StatsJobModel.RUNNING]
+    executor = ThreadPoolExecutor(config["StatsJobs"]["workers"], thread_name_prefix="stats-job")
+    held_jobs: Set[int] = set()
+    lock = threading.Lock()
+    heartbeat_thread: threading.Thread | None = None
+
+    @staticmethod
+    def get_upload_path(job_id: int) -> str:
+        return os.path.join(config["StatsJobs"]["uploads_dir"], f"stats_job_{job_id}.txt")
+
+    @staticmethod
+    def submit(pin_length: int, file_buffer: UploadedFile, append: bool = False) -> StatsJobModel:
+        job = StatsJobModel.objects.create(pin_length=pin_length, append=append)
+        StatsJobs.hold(job.id)
+
+        # the upload only lives as long as the request
+        os.makedirs(config["StatsJobs"]["uploads_dir"], exist_ok=True)
+        filename = StatsJobs.get_upload_path(job.id)
+        with open(filename, 'wb') as f:
+            if hasattr(file_buffer, 'temporary_file_path'):
+                with open(file_buffer.temporary_file_path(), 'rb') as upload:
+                    shutil.copyfileobj(upload, f)
+            else:
+                for chunk in file_buffer.chunks():
+                    f.write(chunk)
+
+        StatsJobs.executor.submit(StatsJobs.run, job.id, filename)
+        return job
+
+    @staticmethod
+    def run(job_id: int, filename: str) -> None:
+        close_old_connections()
+        try:
+            job = StatsJobModel.objects.get(id=job_id)
+            if job.status != StatsJobModel.PENDING:
+                # failed meanwhile as stale
+                return
+            StatsJobs.update(job_id, status=StatsJobModel.RUNNING)
+
+            sb = StatsBuilder(
+                filename=filename,
+                expected_pin_len=job.pin_length,
+                workers=config["StatsBuilder"]["workers"],
+                progress=StatsJobs.progress_updater(job_id)
+            )
+            sb.save_stats(append=job.append)
+            OrderGuessing.on_stats_published(job.pin_length)
+
+            StatsJobs.update(
+                job_id,
+                status=StatsJobModel.DONE,
+                progress=1.0,
+                message=f"Statistics for PIN code of {ciphers_to_literal[job.pin_length]} "
+                        f"symbols has been correctly {'updated' if job.append else 'generated'}."
+            )
+        except ValueError as e:
+            StatsJobs.update(job_id, status=StatsJobModel.FAILED, message=e.args[0])
+        except Exception as e:
+            traceback.print_exc()
+            StatsJobs.update(job_id, status=StatsJobModel.FAILED, message=repr(e))
+        finally:
+            StatsJobs.release(job_id)
+            if os.path.exists(filename):
+                os.remove(filename)
+            # the thread outlives any request, its connection is never closed by Django
+            connection.close()
+
+    @staticmethod
+    def hold(job_id: int) -> None:
+        with StatsJobs.lock:
+            StatsJobs.held_jobs.add(job_id)
+            if StatsJobs.heartbeat_thread is None:
+                StatsJobs.heartbeat_thread = threading.Thread(
+                    target=StatsJobs.heartbeat, name="stats-job-heartbeat", daemon=True
+                )
+                StatsJobs.heartbeat_thread.start()
+
+    @staticmethod
+    def release(job_id: int) -> None:
+        with StatsJobs.lock:
+            StatsJobs.held_jobs.discard(job_id)
+
+    @staticmethod
+    def heartbeat() -> None:
+        # pending and running jobs of this worker, dead with it if it is stopped
+        while True:
+            time.sleep(config["StatsJobs"]["heartbeat_interval"])
+            with StatsJobs.lock:
+                job_ids = list(StatsJobs.held_jobs)
+            if not job_ids:
+                continue
+            try:
+                StatsJobModel.objects.filter(id__in=job_ids, status__in=StatsJobs.UNFINISHED) \
+                    .update(updated_at=timezone.now())
+            except DatabaseError:
+                traceback.print_exc()
+            finally:
+                connection.close()
+
+    @staticmethod
+    def fail_stale_jobs() -> None:
+        """
+        Fail the unfinished jobs without heartbeat, left by a stopped worker (restart, timeout, deploy),
+        and remove their uploads
+        """
+        deadline = timezone.now() - timedelta(seconds=config["StatsJobs"]["stale_after"])
+        stale_jobs = StatsJobModel.objects.filter(status__in=StatsJobs.UNFINISHED, updated_at__lt=deadline)
+        job_ids = list(stale_jobs.values_list('id', flat=True))
+        if not job_ids:
+            return
+
+        stale_jobs.filter(id__in=job_ids).update(
+            status=StatsJobModel.FAILED,
+            message="The statistics build was interrupted, please submit it again.",
+            updated_at=timezone.now()
+        )
+        for job_id in job_ids:
+            if os.path.exists(StatsJobs.get_upload_path(job_id)):
+                os.remove(StatsJobs.get_upload_path(job_id))
+
+    @staticmethod
+    def update(job_id: int, **fields: Any) -> None:
+        # queryset updates bypass auto_now
+        StatsJobModel.objects.filter(id=job_id).update(updated_at=timezone.now(), **fields)
+
+    @staticmethod
+    def progress_updater(job_id: int) -> Callable[[float], None]:
+        # the progress is written at most once per interval to spare the database
+        last_update = 0.0
+
+        def update(progress: float) -> None:
+            nonlocal last_update
+            now = time.monotonic()
+            if now - last_update >= config["StatsJobs"]["progress_interval"]:
+                last_update = now
+                StatsJobs.update(job_id, progress=progress)
+
+        return update
+
+    @staticmethod
+    def to_json(job: StatsJobModel) -> Dict[str, Any]:
+        return {
+            'id': job.id,
+            'pin_length': job.pin_length,
+            'append': job.append,
+            'status': job.status,
+            'progress': job.progress,
+            'message': job.message,
+        }
+
+
+def warm_up() -> None:
+    # hook of the server workers, the database may not be migrated yet
+    try:
+        StatsJobs.fail_stale_jobs()
+    except DatabaseError as e:
+        print(f"Stale statistics builds not checked: {e!r}")
@@ -0,0 +1,126 @@
+from typing import *
+import os
+import threading
+
+import numpy as np
+import numpy.typing as npt
+
+from api.config import config
+from api.views.pinRanking import FrequencyScorer
+from utils.cipher_to_literal import ciphers_to_literal
+from utils.stats_format import load_meta, load_table, get_table_paths, META_FILE, \
+    NORMALISED_TABLES
+
+
+class StatsBundle:
+    """
+    Read-only statistics of one PIN length, never modified once loaded: a rebuild yields a new bundle
+    """
+
+    def __init__(
+            self,
+            pin_length: int,
+            version: Tuple[int, ...],
+            transition_mat: npt.NDArray[float],
+            prob_by_index: npt.NDArray[float],
+            freq: npt.NDArray[float]
+    ):
+        self.pin_length = pin_length
+        self.version = version
+        self.transition_mat = transition_mat
+        self.prob_by_index = prob_by_index
+        self.freq = freq
+        for table in (self.transition_mat, self.prob_by_index, self.freq):
+            table.flags.writeable = False
+
+        self.__freq_prefix_max = None
+        self.__lock = threading.Lock()
+
+    @property
+    def freq_prefix_max(self) -> List[npt.NDArray[float]]:
+        # derived table only needed by the top-k search, built on first use
+        with self.__lock:
+            if self.__freq_prefix_max is None:
+                self.__freq_prefix_max = FrequencyScorer.build_prefix_max(self.freq, self.pin_length)
+            return self.__freq_prefix_max
+
+
+class StatsRegistry:
+    """
+    Statistics bundles by PIN length, lazily loaded once and hot-swapped when a new build is published.
+    Each length has its own lock so that requests for different lengths never wait for each other
+    """
+
+    def __init__(self, stats_dir_template: str):
+        self.stats_dir_template = stats_dir_template
+        self.bundles: Dict[int, StatsBundle] = {}
+        self.locks: Dict[int, threading.Lock] = {}
+        self.lock = threading.Lock()
+
+    def get_dir(self, pin_length: int) -> str:
+        return self.stats_dir_template.replace("###", ciphers_to_literal[pin_length])
+
+    def get_meta_path(self, pin_length: int) -> str:
+        return os.path.join(self.get_dir(pin_length), META_FILE)
+
+    def has_stats(self, pin_length: int) -> bool:
+        meta_path = self.get_meta_path(pin_length)
+        try:
+            paths = get_table_paths(self.get_dir(pin_length), load_meta(meta_path))
+        except (FileNotFoundError, ValueError):
+            return False
+        return all(name in paths and os.path.exists(paths[name]) for name in NORMALISED_TABLES)
+
+    def get_version(self, pin_length: int) -> Tuple[int, ...]:
+        """
+        Identity of meta.json, which is atomically replaced, thus changed, by every published build
+        """
+        try:
+            stat = os.stat(self.get_meta_path(pin_length))
+        except FileNotFoundError:
+            raise FileNotFoundError("The stats file does not exist. Please generate it first.")
+        return stat.st_mtime_ns, stat.st_ino
+
+    def get(self, pin_length: int) -> StatsBundle:
+        version = self.get_version(pin_length)
+        bundle = self.bundles.get(pin_length)
+        if bundle is not None and bundle.version == version:
+            return bundle
+
+        with self.lock:
+            length_lock = self.locks.setdefault(pin_length, threading.Lock())
+
+        with length_lock:
+            # another thread may have loaded it in the meantime
+            bundle = self.bundles.get(pin_length)
+            if bundle is None or bundle.version != version:
+                try:
+                    bundle = self.load(pin_length, version)
+                except FileNotFoundError:
+                    # the tables of the build were removed by a newer one published meanwhile
+                    bundle = self.load(pin_length, self.get_version(pin_length))
+                self.bundles[pin_length] = bundle
+
+        return bundle
+
+    def load(self, pin_length: int, version: Tuple[int, ...]) -> StatsBundle:
+        meta_path = self.get_meta_path(pin_length)
+        meta = load_meta(meta_path)
+        if meta["pin_length"] != pin_length:
+            raise ValueError(f"The stats in {meta_path} are for PIN codes of {meta['pin_length']} symbols")
+
+        # memory-mapped, hence shared with the other workers through the page cache
+        paths = get_table_paths(self.get_dir(pin_length), meta)
+        return StatsBundle(
+            pin_length,
+            version,
+            load_table(paths["transition_matrix"]),
+            load_table(paths["prob_by_index"]),
+            load_table(paths["frequencies"])
+        )
+
+    def invalidate(self, pin_length: int) -> None:
+        self.bundles.pop(pin_length, None)
+
+
+stats_registry = StatsRegistry(config["OrderGuessing"]["stats_dir"])
@@ -1,52 +1,106 @@
+from datetime import datetime
+import hashlib
+
+from django.db import transaction
+from django.db.models import Prefetch
 from django.http import HttpResponse
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition
 from rest_framework.views import APIView
 
 
+from api.config import config
 from api.serializers import ReferenceSerializer
 from django.core.handlers.wsgi import WSGIRequest
 
 import json
 
 from api.views.imageMisc import *
-from api.views.modelWrapper import ModelWrapper
+from api.views.modelWrapper import get_model_wrapper, get_inference_metrics
+from api.views.inferenceCache import InferenceResult, inference_cache
+from api.views.imageStore import image_store
+from api.views.referenceLayouts import ReferenceLayouts, reference_layouts
 from api.views.digitRecognition import *
 from api.views.orderGuessing import *
+from api.views.statsJobs import StatsJobs
+from api.models import ReferenceModel, BoundingBoxModel, StatsJobModel
 from utils.cipher_to_literal import ciphers_to_literal
-from api.views.boundingBox import select_bounding_boxes
+from api.views.boundingBox import BoundingBoxes, select_bounding_boxes
+
+
+def get_references_state(request: WSGIRequest) -> Tuple[int, datetime | None]:
+    # the layouts version changes with every reference added, updated or deleted, read once per request
+    if not hasattr(request, 'references_state'):
+        request.references_state = ReferenceLayouts.get_db_state()
+    return request.references_state
+
+
+def get_references_etag(request: WSGIRequest, *args, **kwargs) -> str:
+    version, _ = get_references_state(request)
+    return hashlib.blake2b(json.dumps([version, algorithms]).encode(), digest_size=8).hexdigest()
+
+
+def get_references_last_modified(request: WSGIRequest, *args, **kwargs) -> datetime | None:
+    return get_references_state(request)[1]
 
 
 class PhoneReferences(APIView):
     serializer_class = ReferenceSerializer
+    page_size = config["ReferenceLayouts"]["page_size"]
 
+    @method_decorator(condition(etag_func=get_references_etag, last_modified_func=get_references_last_modified))
     def get(self, request):
-        references = ReferenceModel.objects.all()
-        serializer = ReferenceSerializer(references, many=True)
+        """
+        References ordered by name with their boxes, optionally starting with a prefix. The pages hold up to
+        limit references, the next one starting after the cursor given by the previous one
+        """
+        try:
+            limit = min(max(int(request.GET.get('limit', self.page_size)), 1), self.page_size)
+        except ValueError:
+            return HttpResponse("Invalid limit", status=400)
+
+        references = ReferenceModel.objects.order_by('ref').prefetch_related(
+            Prefetch('boundingBoxes', queryset=BoundingBoxModel.objects.order_by('cipher'))
+        )
+        if request.GET.get('prefix'):
+            references = references.filter(ref__startswith=request.GET['prefix'])
+        if request.GET.get('cursor'):
+            references = references.filter(ref__gt=request.GET['cursor'])
+
+        # one more reference tells whether there is a next page
+        references = list(references[:limit + 1])
+        next_cursor = references[limit - 1].ref if len(references) > limit else None
+
+        serializer = ReferenceSerializer(references[:limit], many=True)
         data = json.dumps({
             "refs": serializer.data,
+            "next": next_cursor,
             "order_guessing_algorithms": algorithms
         })
-        return HttpResponse(data, content_type='application/json')
+        response = HttpResponse(data, content_type='application/json')
+        # cached by the clients, revalidated with the ETag
+        patch_cache_control(response, no_cache=True)
+        return response
 
     def post(self, request):
         image = preprocess_image(request.FILES['phone'])
         reference = request.POST.get('ref')
 
-        image = model_wrapper.segment_phone(image)
+        image = get_model_wrapper().segment_phone(image)
         if image is None:
             return HttpResponse(status=422)
 
         bboxes = DigitRecognition(img=image).process_data()
-        ref_m = ReferenceModel.objects.create(ref=reference)
-        ref_m.save()
-        for i, bb in enumerate(bboxes):
-            bb_m = BoundingBoxModel(x=bb.x, y=bb.y, w=bb.w, h=bb.h, cipher=i, ref=ref_m)
-            bb_m.save()
+        ref_m = ReferenceModel(ref=reference)
+        reference_layouts.save(ref_m, bboxes.xywh())
 
         response = {
-            'image': get_b64_img_from_np_array(image),
-            'bboxes': [bb.xywh() for bb in bboxes],
+            **get_image_fields(image, get_known_images(request)),
+            'bboxes': bboxes.xywh(),
             'ref': reference,
             'id': ref_m.id
         }
@@ -56,23 +110,18 @@ class PhoneReferences(APIView):
         ref = request.POST.get('ref')
         image = preprocess_image(request.FILES['phone'])
 
-        image = model_wrapper.segment_phone(image)
+        image = get_model_wrapper().segment_phone(image)
         if image is None:
             return HttpResponse(status=422)
 
         bboxes = DigitRecognition(img=image).process_data()
 
         ref_m = ReferenceModel.objects.get(id=pk)
-
-        BoundingBoxModel.objects.filter(ref=ref_m).delete()
-        for i, bb in enumerate(bboxes):
-            BoundingBoxModel.objects.update_or_create(
-                ref=ref_m, cipher=i, defaults={'x': bb.x, 'y': bb.y, 'w': bb.w, 'h': bb.h}
-            )
+        reference_layouts.save(ref_m, bboxes.xywh())
 
         response = {
-            'image': get_b64_img_from_np_array(image),
-            'bboxes': [bb.xywh() for bb in bboxes],
+            **get_image_fields(image, get_known_images(request)),
+            'bboxes': bboxes.xywh(),
             'ref': ref,
             'id': ref_m.id
         }
@@ -80,20 +129,16 @@ class PhoneReferences(APIView):
 
     @staticmethod
     def delete(request, pk):
-        ReferenceModel.objects.filter(id=pk).delete()
+        with transaction.atomic():
+            ReferenceModel.objects.filter(id=pk).delete()
+            reference_layouts.invalidate()
         return HttpResponse(status=201)
 
 
-model_wrapper = ModelWrapper()
-
-
 @csrf_exempt
 def find_pin_code(request: WSGIRequest) -> HttpResponse:
 
     user_config = json.loads(request.POST.get('config'))
-    order_guessing_algorithms = user_config['order_guessing_algorithms']
-    order_cipher_guesses = user_config['order_cipher_guesses']
-
     new_pin_length = user_config['pin_length']
     if not OrderGuessing.check_new_pin_length(new_pin_length):
         return HttpResponse(f"No statistics built for PIN codes of {ciphers_to_literal[new_pin_length]} symbols.\n"
@@ -104,28 +149,121 @@ def find_pin_code(request: WSGIRequest) -> HttpResponse:
     filename = image.name
     image = preprocess_image(image)
 
-    seg_img = model_wrapper.segment_phone(image)
-    if seg_img is None:
+    result = run_models([image], filename)[0]
+    if result.warped is None:
         return HttpResponse(f"The image {filename} does not appear to contain a phone", status=422)
 
-    b64_img = get_b64_img_from_np_array(seg_img)
+    response, status = infer_pin_codes(result, filename, ref, user_config, get_known_images(request))
+    if isinstance(response, str):
+        return HttpResponse(response, status=status)
+    return HttpResponse(json.dumps(response), content_type="application/json", status=status)
+
+
+@csrf_exempt
+def find_pin_codes(request: WSGIRequest) -> HttpResponse:
+    """
+    find-pin-code for all the photos of a case at once, the models running on batches of images.
+    Each result holds the status and the content find-pin-code would have answered for its image
+    """
+    user_config = json.loads(request.POST.get('config'))
+    new_pin_length = user_config['pin_length']
+    if not OrderGuessing.check_new_pin_length(new_pin_length):
+        return HttpResponse(f"No statistics built for PIN codes of {ciphers_to_literal[new_pin_length]} symbols.\n"
+                            f"Would you like to build new statistics for this length ?", status=422)
+
+    ref = request.POST.get('ref')
+    images = request.FILES.getlist("images")
+    filenames = [image.name for image in images]
+    models_results = run_models([preprocess_image(image) for image in images])
+
+    known_images = get_known_images(request)
+    results = []
+    for result, filename in zip(models_results, filenames):
+        if result.warped is None:
+            results.append({
+                'status': 422,
+                'filename': filename,
+                'msg': f"The image {filename} does not appear to contain a phone"
+            })
+            continue
+
+        response, status = infer_pin_codes(result, filename, ref, user_config, known_images)
+        if isinstance(response, str):
+            response = {'filename': filename, 'msg': response}
+        results.append({'status': status, **response})
+
+    return HttpResponse(json.dumps({'results': results}), content_type="application/json", status=200)
+
+
+def run_models(images: List[np.ndarray], name: LiteralString = 'smudges') -> List[InferenceResult]:
+    """
+    Warped phones and smudges of the images, the models only running on the images never processed before
+    """
+    keys = [inference_cache.get_key(image) if inference_cache else None for image in images]
+    results = [inference_cache.get(key) if inference_cache else None for key in keys]
+
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        model_wrapper = get_model_wrapper()
+        seg_imgs = model_wrapper.segment_phones([images[i] for i in missing])
+        phones = [j for j, seg_img in enumerate(seg_imgs) if seg_img is not None]
+        phones_bboxes = dict(zip(phones, model_wrapper.detect_smudges([seg_imgs[j] for j in phones], name)
+                                 if phones else []))
+
+        for j, i in enumerate(missing):
+            results[i] = InferenceResult(seg_imgs[j], phones_bboxes.get(j, BoundingBoxes()))
+            if inference_cache:
+                inference_cache.put(keys[i], results[i])
+
+    return results
+
+
+def get_known_images(request: WSGIRequest) -> Set[str]:
+    # ids of the images the client already has, given by the previous responses
+    return set(json.loads(request.POST.get('known_images', '[]')))
+
+
+def get_image_fields(image: np.ndarray, known_images: Collection[str] = ()) -> Dict[str, str]:
+    """
+    Id and URL of an image of a response, only encoded and stored when the client does not have it yet
+    """
+    image_id = image_store.get_id(image)
+    if image_id not in known_images:
+        image_store.put(image, image_id)
+    return {'image_id': image_id, 'image': reverse('image', args=[image_id])}
+
+
+def infer_pin_codes(
+        result: InferenceResult,
+        filename: str,
+        ref: str,
+        user_config: Dict[str, Any],
+        known_images: Collection[str] = ()
+) -> Tuple[Dict[str, Any] | str, int]:
+    """
+    Most probable PIN codes of the smudges detected on a warped phone,
+    as the content (JSON object or error message) and the status of the response
+    """
+    order_guessing_algorithms = user_config['order_guessing_algorithms']
+    order_cipher_guesses = user_config['order_cipher_guesses']
+    new_pin_length = user_config['pin_length']
 
-    bboxes = model_wrapper.detect_smudge(seg_img, filename)
+    image_fields = get_image_fields(result.warped, known_images)
 
-    ciphers, refs_bboxes = guess_ciphers(bboxes, ref)
+    ciphers, refs_bboxes, bboxes = guess_ciphers(result.bboxes, ref, result.guesses)
 
     if len(ciphers) != new_pin_length and user_config['inference_correction'] == 'manual':
 
         response = {
             'reference': ref,
             'filename': filename,
-            'image': b64_img,
+            **image_fields,
             'ref_bboxes': refs_bboxes,
-            'inferred_bboxes': [bb.xywh() for bb in bboxes],
+            'inferred_bboxes': bboxes.xywh(),
             'inferred_ciphers': [int(cipher[0]) for cipher in ciphers],
             'msg': 'The number of detected ciphers does not match the expected PIN length'
         }
-        return HttpResponse(json.dumps(response), content_type="application/json", status=206)
+        return response, 206
 
     known_ciphers = [cipher for cipher in order_cipher_guesses if cipher != '']
     delta = new_pin_length - len(ciphers[:, 0])
@@ -136,25 +274,25 @@ def find_pin_code(request: WSGIRequest) -> HttpResponse:
                 delta -= 1
 
     if delta < 0:
-        return HttpResponse(f"Guessed ciphers are incompatible with the inferred ciphers", status=422)
+        return f"Guessed ciphers are incompatible with the inferred ciphers", 422
 
     most_likely_pin_codes = OrderGuessing.case_handler(ciphers, order_guessing_algorithms, order_cipher_guesses)
     final_bboxes = select_bounding_boxes(
         [int(cipher) for cipher in most_likely_pin_codes[0]],
         ciphers[:, 0].tolist(),
         bboxes,
-        [BoundingBox(ref_bb) for ref_bb in refs_bboxes]
+        BoundingBoxes(refs_bboxes)
     )
 
     response = {
-        'image': b64_img,
+        **image_fields,
         'pin_codes': most_likely_pin_codes,
         'filename': filename,
         'reference': ref,
         'ref_bboxes': refs_bboxes,
-        'inferred_bboxes': [f_bb.xywh() for f_bb in final_bboxes],
+        'inferred_bboxes': final_bboxes.xywh(),
     }
-    return HttpResponse(json.dumps(response), content_type="application/json", status=200)
+    return response, 200
 
 
 @csrf_exempt
@@ -167,7 +305,7 @@ def find_pin_code_manual_corrected_inference(request: WSGIRequest) -> HttpRespon
     order_cipher_guesses = user_config['order_cipher_guesses']
 
     ciphers = np.array(new_ciphers)
-    most_likely_pin_codes = OrderGuessing.process(ciphers, order_guessing_algorithms, order_cipher_guesses)
+    most_likely_pin_codes = OrderGuessing.process_cached(ciphers, order_guessing_algorithms, order_cipher_guesses)
 
     response = {
         'pin_codes': [pin[0] for pin in most_likely_pin_codes],
@@ -184,7 +322,7 @@ def update_pin_code(request: WSGIRequest) -> HttpResponse:
     user_config = json.loads(request.POST.get('config'))
     order_guessing_algorithms = user_config['order_guessing_algorithms']
     order_cipher_guesses = user_config['order_cipher_guesses']
-    most_likely_pin_codes = OrderGuessing.process(ciphers, order_guessing_algorithms, order_cipher_guesses)
+    most_likely_pin_codes = OrderGuessing.process_cached(ciphers, order_guessing_algorithms, order_cipher_guesses)
     response = {
         'pin_codes': [pin[0] for pin in most_likely_pin_codes]
     }
@@ -193,14 +331,46 @@ def update_pin_code(request: WSGIRequest) -> HttpResponse:
 
 @csrf_exempt
 def build_statistics(request: WSGIRequest) -> HttpResponse:
+    # the build may outlast the request, it runs in background and its progress is polled
     pin_length = int(request.POST.get('new_pin_length'))
     file_content = request.FILES.get('reference_file')
-    try:
-        OrderGuessing.generate_stats(pin_length, file_content)
-    except ValueError as e:
-        return HttpResponse(e.args[0], status=422)
+    if file_content is None:
+        return HttpResponse("No reference file provided", status=422)
+
+    # the corpus may be added to the current statistics, which keep their raw counts
+    append = request.POST.get('append', 'false').lower() == 'true'
+    job = StatsJobs.submit(pin_length, file_content, append)
+    return HttpResponse(json.dumps(StatsJobs.to_json(job)), content_type="application/json", status=202)
+
+
+def build_statistics_status(request: WSGIRequest, pk: int) -> HttpResponse:
+    # the job may have been left by a stopped worker
+    StatsJobs.fail_stale_jobs()
+    job = StatsJobModel.objects.filter(id=pk).first()
+    if job is None:
+        return HttpResponse(f"No statistics build with id {pk}", status=404)
+
+    return HttpResponse(json.dumps(StatsJobs.to_json(job)), content_type="application/json", status=200)
+
+
+def inference_metrics(request: WSGIRequest) -> HttpResponse:
+    # the caches are the ones of the worker answering, reported even without micro-batching
+    metrics = get_inference_metrics()
+    metrics['inference_cache'] = inference_cache.stats() if inference_cache else None
+    metrics['result_cache'] = OrderGuessing.results_cache.stats()
+
+    return HttpResponse(json.dumps(metrics), content_type="application/json", status=200)
 
-    return HttpResponse(f"Statistics for PIN code of {ciphers_to_literal[pin_length]} "
-                        f"symbols has been correctly generated.", status=201)
 
+@condition(etag_func=lambda request, image_id: image_id)
+def get_image(request: WSGIRequest, image_id: str) -> HttpResponse:
+    """
+    Image of a previous response, by id. The content of an id never changes
+    """
+    data = image_store.get(image_id)
+    if data is None:
+        return HttpResponse(f"No image with id {image_id}, it may have been evicted", status=404)
 
+    response = HttpResponse(data, content_type=image_store.content_type)
+    patch_cache_control(response, private=True, max_age=config["ImageStore"]["max_age"], immutable=True)
+    return response
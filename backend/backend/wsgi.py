@@ -14,3 +14,11 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
 
 application = get_wsgi_application()
+
+# the models are loaded lazily, the server workers load them once before serving
+from api.views.modelWrapper import warm_up
+from api.views import referenceLayouts, statsJobs
+
+warm_up()
+referenceLayouts.warm_up()
+statsJobs.warm_up()
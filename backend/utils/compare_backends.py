@@ -0,0 +1,88 @@
+import argparse
+import glob
+import os
+import time
+from typing import *
+
+import numpy as np
+import cv2
+
+from api.config import config
+from api.views.inferenceBackends import TorchBackend, OnnxBackend, YoloPrediction
+
+
+def boxes_iou(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    # (N, M) IOU of [x_center, y_center, w, h] boxes
+    a_min, a_max = a[:, None, :2] - a[:, None, 2:] / 2, a[:, None, :2] + a[:, None, 2:] / 2
+    b_min, b_max = b[None, :, :2] - b[None, :, 2:] / 2, b[None, :, :2] + b[None, :, 2:] / 2
+    inter = np.prod(np.clip(np.minimum(a_max, b_max) - np.maximum(a_min, b_min), 0, None), axis=-1)
+    return inter / (np.prod(a[:, None, 2:], axis=-1) + np.prod(b[None, :, 2:], axis=-1) - inter)
+
+
+def polygons_iou(a: np.ndarray, b: np.ndarray, shape: Tuple[int, int]) -> float:
+    masks = [cv2.fillPoly(np.zeros(shape, dtype=np.uint8), [p.astype(np.int32)], 1) for p in (a, b)]
+    return float((masks[0] & masks[1]).sum() / max((masks[0] | masks[1]).sum(), 1))
+
+
+def compare(reference: YoloPrediction, other: YoloPrediction) -> Dict[str, float]:
+    """
+    Parity of the predictions of an image: difference in number of boxes, mean IOU of the best matches
+    of the reference boxes and IOU of the first masks
+    """
+    parity = {'missing_boxes': len(reference.boxes) - len(other.boxes), 'boxes_iou': 1.0, 'mask_iou': 1.0}
+    if len(reference.boxes) and len(other.boxes):
+        parity['boxes_iou'] = float(boxes_iou(reference.boxes, other.boxes).max(axis=1).mean())
+    elif len(reference.boxes) or len(other.boxes):
+        parity['boxes_iou'] = 0.0
+
+    if reference.polygons is not None or other.polygons is not None:
+        if reference.polygons is None or other.polygons is None:
+            parity['mask_iou'] = 0.0
+        else:
+            parity['mask_iou'] = polygons_iou(reference.polygons[0], other.polygons[0], reference.image.shape[:2])
+    return parity
+
+
+def latency(backend: TorchBackend | OnnxBackend, images: List[np.ndarray], runs: int) -> float:
+    # median time per image in ms, after a warm-up run
+    backend(images)
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        backend(images)
+        timings.append((time.perf_counter() - start) / len(images))
+    return float(np.median(timings) * 1000)
+
+
+if __name__ == '__main__':
+    # run from the backend directory: python -m utils.compare_backends <images directory>
+    parser = argparse.ArgumentParser(description="Parity and latency of the ONNX Runtime backend against PyTorch")
+    parser.add_argument('images', help="directory of phone photos")
+    parser.add_argument('--weights', nargs='*', default=[config["ModelWrapper"]["phone_seg_weights"],
+                                                         config["ModelWrapper"]["smudges_det_weights"]])
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--threads', type=int, default=config["ModelWrapper"]["Onnx"]["intra_op_threads"])
+    parser.add_argument('--batch-size', type=int, default=config["ModelWrapper"]["batch_size"])
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    # same preprocessing as the uploads
+    images = [cv2.resize(cv2.imread(path), (config["width"], config["height"]))
+              for path in sorted(glob.glob(os.path.join(args.images, '*')))
+              if cv2.haveImageReader(path)][:args.batch_size]
+
+    onnx_config = {**config["ModelWrapper"]["Onnx"], 'quantize': args.quantize, 'intra_op_threads': args.threads}
+    for weights in args.weights:
+        torch_backend = TorchBackend(weights)
+        onnx_backend = OnnxBackend(weights, **onnx_config)
+
+        parities = [compare(reference, other) for reference, other in zip(torch_backend(images), onnx_backend(images))]
+        print(f"{weights} on {len(images)} images")
+        for key in parities[0]:
+            values = np.array([parity[key] for parity in parities])
+            worst = values.min() if key.endswith('iou') else np.abs(values).max()
+            print(f"  {key}: mean {values.mean():.4f}, worst {worst:.4f}")
+
+        torch_ms = latency(torch_backend, images, args.runs)
+        onnx_ms = latency(onnx_backend, images, args.runs)
+        print(f"  latency per image: torch {torch_ms:.1f} ms, onnx {onnx_ms:.1f} ms ({torch_ms / onnx_ms:.2f}x)")
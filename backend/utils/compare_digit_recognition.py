@@ -0,0 +1,75 @@
+import argparse
+import glob
+import json
+import os
+import time
+from typing import *
+
+import cv2
+import numpy as np
+
+# DigitRecognition reads the reference models
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
+import django
+django.setup()
+
+from api.config import config
+from api.views.digitRecognition import DigitRecognition
+
+
+def process(image: np.ndarray, grouping: str) -> Tuple[List[List[float]] | str, float]:
+    # boxes of the keypad, or the error raised, and the time taken in ms
+    config["DigitRecognition"]["grouping"] = grouping
+    start = time.perf_counter()
+    try:
+        bboxes = DigitRecognition(img=image.copy()).process_data().data.tolist()
+    except Exception as e:
+        bboxes = repr(e)
+    return bboxes, (time.perf_counter() - start) * 1000
+
+
+if __name__ == '__main__':
+    # run from the backend directory: python -m utils.compare_digit_recognition <images directory>
+    parser = argparse.ArgumentParser(description="Regression of the keypad layouts found by DigitRecognition")
+    parser.add_argument('images', help="directory of warped phone images")
+    parser.add_argument('--grouping', nargs='*', default=['dbscan', 'contours'])
+    parser.add_argument('--save', help="write the layouts to this JSON file")
+    parser.add_argument('--expected', help="JSON file of layouts written by --save to compare against")
+    args = parser.parse_args()
+
+    paths = [path for path in sorted(glob.glob(os.path.join(args.images, '*'))) if cv2.haveImageReader(path)]
+    expected = {}
+    if args.expected:
+        with open(args.expected) as f:
+            expected = json.load(f)
+
+    layouts = {}
+    for grouping in args.grouping:
+        layouts[grouping] = {}
+        timings = []
+        differences = []
+        for path in paths:
+            image = cv2.resize(cv2.imread(path), (config["width"], config["height"]))
+            # first run excluded from the timings, it imports the clustering
+            process(image, grouping)
+            bboxes, elapsed = process(image, grouping)
+            layouts[grouping][os.path.basename(path)] = bboxes
+            timings.append(elapsed)
+
+            reference = expected.get(grouping, expected.get('dbscan', {})).get(os.path.basename(path))
+            if reference is None:
+                continue
+            if isinstance(bboxes, str) or isinstance(reference, str):
+                differences.append(0.0 if bboxes == reference else np.inf)
+            else:
+                differences.append(float(np.abs(np.array(bboxes) - np.array(reference)).max()))
+
+        print(f"{grouping} on {len(paths)} images: median {np.median(timings):.1f} ms per image")
+        if differences:
+            differences = np.array(differences)
+            print(f"  identical layouts: {(differences == 0).sum()}/{len(differences)}, "
+                  f"worst difference {differences.max():.2f} px")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(layouts, f)
@@ -1,85 +1,252 @@
+import argparse
+import multiprocessing
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext
 from tqdm import tqdm
 from typing import *
 
 import random
 import numpy as np
+import psutil
 
-from utils.cipher_to_literal import ciphers_to_literal
+from utils.stats_format import get_stats_dir, publish_stats, load_meta, load_table, get_table_paths, load_counts, \
+    stats_lock, META_FILE
+
+
+class PinCounter:
+    """
+    Occurrences of the PIN codes of a given length read from a corpus, partial counters
+    of several parts of the same corpus being merged by summation
+    """
+    chunk_size = 1 << 24
+
+    def __init__(self, pin_len: int):
+        self.pin_len = pin_len
+        self.counts = np.zeros(10 ** pin_len, dtype=np.int64)
+        self.n_invalid = 0
+
+    def merge(self, other: 'PinCounter') -> 'PinCounter':
+        self.counts += other.counts
+        self.n_invalid += other.n_invalid
+        return self
+
+    def read(
+            self,
+            stream: BinaryIO,
+            start: int = 0,
+            end: Optional[int] = None,
+            on_read: Optional[Callable[[int], None]] = None
+    ) -> None:
+        """
+        Stream the lines starting in the [start, end) byte range by chunks cut on line boundaries
+        so that the memory stays bounded whatever the size of the corpus
+        """
+        if start > 0:
+            # the line overlapping start belongs to the previous range
+            stream.seek(start - 1)
+            start += len(stream.readline()) - 1
+
+        position = start
+        remainder = b''
+        is_first = (start == 0)
+        while end is None or position < end:
+            data = stream.read(self.chunk_size if end is None else min(self.chunk_size, end - position))
+            if not data:
+                break
+
+            position += len(data)
+            if on_read is not None:
+                on_read(len(data))
+
+            data = remainder + data
+            cut = data.rfind(b'\n') + 1
+            data, remainder = data[:cut], data[cut:]
+            if data:
+                self.count_chunk(data, is_first)
+                is_first = False
+
+        if remainder and end is not None:
+            # complete the last line, which starts before the end of the range
+            remainder += stream.readline()
+
+        if remainder:
+            self.count_chunk(remainder if remainder.endswith(b'\n') else remainder + b'\n', is_first)
+
+    def count_chunk(self, data: bytes, is_first: bool = False) -> None:
+        """
+        Parse the newline terminated lines of the chunk as an array of bytes and add their PIN codes to the counts
+        """
+        buffer = np.frombuffer(data, dtype=np.uint8)
+        ends = np.flatnonzero(buffer == ord('\n'))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+
+        # ignore the carriage returns of CRLF files and the empty lines
+        lengths = ends - starts
+        lengths -= (lengths > 0) & (buffer[np.maximum(ends - 1, 0)] == ord('\r'))
+        starts, lengths = starts[lengths > 0], lengths[lengths > 0]
+
+        if is_first and len(lengths) > 0 and lengths[0] != self.pin_len:
+            raise ValueError("The PIN length is not the one expected")
+
+        starts = starts[lengths == self.pin_len]
+        digits = buffer[starts[:, None] + np.arange(self.pin_len)] - ord('0')
+        # bytes below '0' wrap around and are also above 9
+        is_valid = np.all(digits < 10, axis=1)
+        self.n_invalid += len(lengths) - int(is_valid.sum())
+
+        codes = digits[is_valid].astype(np.int64) @ (10 ** np.arange(self.pin_len - 1, -1, -1))
+        self.add_codes(codes)
+
+    def add_codes(self, codes: np.ndarray) -> None:
+        if len(codes) * 8 < len(self.counts):
+            # few codes: avoid allocating a dense temporary as large as the counts
+            values, occurrences = np.unique(codes, return_counts=True)
+            self.counts[values] += occurrences
+        else:
+            self.counts += np.bincount(codes, minlength=len(self.counts))
+
+
+def count_byte_range(filename: str, pin_len: int, start: int, end: int) -> PinCounter:
+    # process pool task: partial counts of one shard of the corpus
+    counter = PinCounter(pin_len)
+    with open(filename, 'rb') as f:
+        counter.read(f, start, end)
+    return counter
 
 
 class StatsBuilder:
     symbols = '0123456789'
-    all_pins_dict = {}
 
     def __init__(
             self,
             filename: Optional[str] = None,
             file_buffer: Optional[BinaryIO] = None,
-            expected_pin_len: int = 6
+            expected_pin_len: int = 6,
+            workers: int = 1,
+            progress: Optional[Callable[[float], None]] = None
     ):
+        """
+        progress, when given, is called with the fraction of the corpus already read instead of
+        displaying progress bars, e.g. to report the progress of a background build
+        """
 
         if filename is None and file_buffer is None:
             raise ValueError("Either filename or file_buffer must be provided")
 
-        content = (open(filename, 'r').read() if filename is not None else
-                   file_buffer.read().decode('utf-8'))
+        self.pin_len = expected_pin_len
+        if filename is not None and workers != 1:
+            counter = self.count_parallel(filename, workers, progress)
+        else:
+            counter = PinCounter(self.pin_len)
+            size = os.path.getsize(filename) if filename is not None else getattr(file_buffer, 'size', None)
+            with (open(filename, 'rb') if filename is not None else nullcontext(file_buffer)) as stream, \
+                    tqdm(total=size, unit='B', unit_scale=True, desc="File reading: ",
+                         disable=progress is not None) as progress_bar:
+                counter.read(stream, on_read=progress_bar.update if progress is None else
+                             self.bytes_progress(progress, size))
 
-        content = content.split('\n')
-        content = content[:-1] if content[-1] == '' else content
-        self.pin_len = len(content[0])
-        if self.pin_len != expected_pin_len:
-            raise ValueError("The PIN length is not the one expected")
+        if counter.n_invalid > 0:
+            print(f"{counter.n_invalid} invalid PIN codes ignored")
 
-        symbols_product_space = len(self.symbols) ** self.pin_len
-        self.all_pins = np.zeros(symbols_product_space)
-        for line in tqdm(content, desc="File reading: "):
-            pin = line.strip()
-            if (len(pin) != self.pin_len) or (not pin.isdigit()):
-                print(f"Invalid PIN: {pin}")
-            self.all_pins_dict[pin] = 1 if self.all_pins_dict.get(pin) is None else self.all_pins_dict[pin] + 1
-            self.all_pins[int(pin)] += 1
-
-        for i in range(symbols_product_space):
-            pin_code = str(i).zfill(self.pin_len)
-            if self.all_pins_dict.get(pin_code) is None:
-                self.all_pins[i] = 1
-                self.all_pins_dict[pin_code] = 1
+        self.set_counts(counter.counts)
 
+    def set_counts(self, counts: np.ndarray) -> None:
+        self.counts = counts
+        # PIN codes never seen are given one occurrence
+        self.all_pins = np.maximum(counts, 1)
         self.sample_size = int(self.all_pins.sum())
 
+    @staticmethod
+    def bytes_progress(progress: Callable[[float], None], size: Optional[int]) -> Callable[[int], None]:
+        read = 0
+
+        def on_read(n_bytes: int) -> None:
+            nonlocal read
+            read += n_bytes
+            if size:
+                progress(min(1.0, read / size))
+
+        return on_read
+
+    def get_max_workers(self) -> int:
+        # each process holds dense counts of 10**pin_len int64, sent back to the parent as a copy
+        # which merges them into its own counts
+        counts_bytes = 8 * 10 ** self.pin_len
+        return max(1, int(psutil.virtual_memory().available // counts_bytes - 1) // 2)
+
+    def count_parallel(
+            self,
+            filename: str,
+            workers: int,
+            progress: Optional[Callable[[float], None]] = None
+    ) -> PinCounter:
+        """
+        Shard the corpus by byte ranges over a process pool (all the cores when workers is 0)
+        and merge the partial counts. The workers are capped by the available memory
+        """
+        workers = min(workers or os.cpu_count(), self.get_max_workers())
+        bounds = np.linspace(0, os.path.getsize(filename), workers + 1).astype(int).tolist()
+
+        counter = PinCounter(self.pin_len)
+        # not forked: the web workers building statistics run threads (models, micro-batching, artefacts)
+        with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('forkserver')) as pool:
+            futures = [pool.submit(count_byte_range, filename, self.pin_len, start, end)
+                       for start, end in zip(bounds[:-1], bounds[1:])]
+            for done, future in enumerate(tqdm(as_completed(futures), total=workers, desc="File reading: ",
+                                               disable=progress is not None), start=1):
+                counter.merge(future.result())
+                if progress is not None:
+                    progress(done / workers)
+
+        return counter
+
     def __compute_frequencies(self) -> np.ndarray:
         return self.all_pins / self.sample_size
 
     def __compute_prob_by_index(self) -> np.ndarray:
+        # one axis per digit: the counts of a digit at an index are the sums over all the other axes
+        counts = self.all_pins.reshape((len(self.symbols),) * self.pin_len)
         prob_by_index = np.zeros((10, self.pin_len))
-        for pin, occ in tqdm(self.all_pins_dict.items(), desc="Probabilities by index computation: "):
-            for index, symbol in enumerate(pin):
-                prob_by_index[int(symbol), index] += occ
+        for index in range(self.pin_len):
+            other_axes = tuple(axis for axis in range(self.pin_len) if axis != index)
+            prob_by_index[:, index] = counts.sum(axis=other_axes)
 
         prob_by_index /= self.sample_size
         return prob_by_index
 
     def __compute_markov_chain_transitions(self) -> np.ndarray:
+        counts = self.all_pins.reshape((len(self.symbols),) * self.pin_len)
         markov_chain_transition = np.zeros((10, 10))
-        for pin, occ in tqdm(self.all_pins_dict.items(), desc="Markov chain transition computation: "):
-            for i in range(self.pin_len - 1):
-                markov_chain_transition[int(pin[i]), int(pin[i + 1])] += occ
+        for i in range(self.pin_len - 1):
+            other_axes = tuple(axis for axis in range(self.pin_len) if axis not in (i, i + 1))
+            markov_chain_transition += counts.sum(axis=other_axes)
 
         row_sums = markov_chain_transition.sum(axis=1, keepdims=True)
         np.divide(markov_chain_transition, row_sums, out=markov_chain_transition, where=row_sums != 0)
         return markov_chain_transition
 
-    def save_stats(self):
-        path = f'resources/stats/{ciphers_to_literal[self.pin_len]}_symbols/'
-        os.makedirs(path, exist_ok=True)
-        self.__compute_frequencies().dump(path + "frequenciesDump")
-        self.__compute_prob_by_index().dump(path + "probByIndexDump")
-        self.__compute_markov_chain_transitions().dump(path + "markovChainTransitionMatDump")
+    def save_stats(self, append: bool = False) -> str:
+        """
+        Publish the statistics of the corpus or, when appending, of the corpus added to the ones already
+        published: their raw counts are summed and the tables normalised again, without reading the former corpus
+        """
+        stats_dir = get_stats_dir(self.pin_len)
+        with stats_lock(stats_dir):
+            if append:
+                self.set_counts(self.counts + load_counts(stats_dir, self.pin_len))
+
+            return publish_stats(stats_dir, self.pin_len, {
+                'frequencies': self.__compute_frequencies(),
+                'prob_by_index': self.__compute_prob_by_index(),
+                'transition_matrix': self.__compute_markov_chain_transitions(),
+                'counts': self.counts,
+            }, sample_size=self.sample_size)
 
     @staticmethod
     def get_pin_codes_acc_freq(n: int, pin_length: int = 6) -> List[str]:
-        f = np.load(f"../resources/stats/{ciphers_to_literal[pin_length]}_symbols/frequenciesDump", allow_pickle=True)
+        stats_dir = get_stats_dir(pin_length)
+        f = load_table(get_table_paths(stats_dir, load_meta(os.path.join(stats_dir, META_FILE)))['frequencies'])
 
         intervals = np.cumsum(f)
 
@@ -93,5 +260,25 @@ class StatsBuilder:
 
 
 if __name__ == '__main__':
-    for pin_code in StatsBuilder.get_pin_codes_acc_freq(40):
-        print(pin_code)
+    # run from the backend directory: python -m utils.generate_stats ...
+    parser = argparse.ArgumentParser(description="PIN codes statistics")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    build_parser = subparsers.add_parser('build', help="build the statistics from a corpus of PIN codes")
+    build_parser.add_argument('corpus', help="file with one PIN code per line")
+    build_parser.add_argument('--pin-length', type=int, default=6)
+    build_parser.add_argument('--workers', type=int, default=0, help="processes to use, 0 for all the cores, capped by the available memory")
+    build_parser.add_argument('--append', action='store_true',
+                              help="add the corpus to the current statistics instead of replacing them")
+
+    sample_parser = subparsers.add_parser('sample', help="draw PIN codes according to the built frequencies")
+    sample_parser.add_argument('-n', type=int, default=40)
+    sample_parser.add_argument('--pin-length', type=int, default=6)
+
+    args = parser.parse_args()
+    if args.command == 'build':
+        sb = StatsBuilder(filename=args.corpus, expected_pin_len=args.pin_length, workers=args.workers)
+        sb.save_stats(append=args.append)
+    else:
+        for pin_code in StatsBuilder.get_pin_codes_acc_freq(args.n, args.pin_length):
+            print(pin_code)
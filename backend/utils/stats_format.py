@@ -0,0 +1,180 @@
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+import uuid
+from typing import *
+
+import numpy as np
+from filelock import FileLock
+
+from utils.cipher_to_literal import ciphers_to_literal
+
+# On-disk format of the statistics of one PIN length, in resources/stats/<length literal>_symbols/:
+#   meta.json                   format version, PIN length and table files, written last
+#   transition_matrix.npy       (10, 10) float64
+#   prob_by_index.npy           (10, pin_length) float64
+#   frequencies.npy             (10^pin_length,) float32
+#   counts.npy                  (10^pin_length,) int64, raw occurrences of the PIN codes before smoothing,
+#                               to which the counts of a new corpus are added without reprocessing the former ones
+# Plain .npy files (no pickle) are memory-mapped read-only, thus shared by all the workers through the page cache.
+# A build publishes its tables under new names (e.g. frequencies.<build>.npy) and then atomically replaces
+# meta.json to point to them, so that readers never see a mix of two builds
+FORMAT_VERSION = 1
+
+TABLE_FILES = {
+    'transition_matrix': 'transition_matrix.npy',
+    'prob_by_index': 'prob_by_index.npy',
+    'frequencies': 'frequencies.npy',
+    'counts': 'counts.npy',
+}
+
+# tables needed to rank the PIN codes, the converted statistics have no raw counts
+NORMALISED_TABLES = ('transition_matrix', 'prob_by_index', 'frequencies')
+
+TABLE_DTYPES = {
+    'transition_matrix': np.float64,
+    'prob_by_index': np.float64,
+    'frequencies': np.float32,
+    'counts': np.int64,
+}
+
+META_FILE = 'meta.json'
+LOCK_FILE = '.lock'
+
+# pickled dumps written by the former StatsBuilder.save_stats
+LEGACY_FILES = {
+    'transition_matrix': 'markovChainTransitionMatDump',
+    'prob_by_index': 'probByIndexDump',
+    'frequencies': 'frequenciesDump',
+}
+
+
+def get_stats_dir(pin_length: int) -> str:
+    return f'resources/stats/{ciphers_to_literal[pin_length]}_symbols/'
+
+
+def atomic_write(path: str, write: Callable[[BinaryIO], None]) -> None:
+    # write aside and rename so that a worker never maps a partially written file,
+    # each thread having its own temporary file
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def save_table(directory: str, name: str, table: np.ndarray, filename: Optional[str] = None) -> None:
+    table = np.ascontiguousarray(table, dtype=TABLE_DTYPES[name])
+    path = os.path.join(directory, filename or TABLE_FILES[name])
+    atomic_write(path, lambda f: np.save(f, table, allow_pickle=False))
+
+
+def save_meta(directory: str, pin_length: int, **extra: Any) -> None:
+    meta = {'format_version': FORMAT_VERSION, 'pin_length': pin_length, **extra}
+    atomic_write(os.path.join(directory, META_FILE), lambda f: f.write(json.dumps(meta).encode('utf-8')))
+
+
+def load_meta(path: str) -> Dict[str, Any]:
+    with open(path, 'r') as f:
+        meta = json.load(f)
+
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError(f"Unsupported statistics format version {meta.get('format_version')} in {path}")
+    return meta
+
+
+def get_table_paths(directory: str, meta: Dict[str, Any]) -> Dict[str, str]:
+    # converted stats use the default names
+    tables = meta.get('tables', {name: TABLE_FILES[name] for name in NORMALISED_TABLES})
+    return {name: os.path.join(directory, filename) for name, filename in tables.items()}
+
+
+def load_table(path: str) -> np.ndarray:
+    return np.load(path, mmap_mode='r', allow_pickle=False)
+
+
+def stats_lock(directory: str) -> FileLock:
+    # serialises the read-modify-publish cycles of a directory across threads and processes
+    os.makedirs(directory, exist_ok=True)
+    return FileLock(os.path.join(directory, LOCK_FILE))
+
+
+def load_counts(directory: str, pin_length: int) -> np.ndarray:
+    """
+    Raw counts of the published statistics, zeros when none was published yet
+    """
+    meta_path = os.path.join(directory, META_FILE)
+    if not os.path.exists(meta_path):
+        return np.zeros(10 ** pin_length, dtype=TABLE_DTYPES['counts'])
+
+    meta = load_meta(meta_path)
+    paths = get_table_paths(directory, meta)
+    if meta['pin_length'] != pin_length or 'counts' not in paths:
+        raise ValueError("The current statistics cannot be updated, please build them again from the whole corpus")
+    return np.array(load_table(paths['counts']))
+
+
+def publish_stats(directory: str, pin_length: int, tables: Dict[str, np.ndarray], **extra: Any) -> str:
+    """
+    Atomically publish a new build of the statistics: the tables are written under new names
+    before meta.json is replaced, then the tables of the previous build are removed.
+    Return the build identifier
+    """
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META_FILE)
+    previous_paths = set(get_table_paths(directory, load_meta(meta_path)).values()) \
+        if os.path.exists(meta_path) else set()
+
+    build = f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    filenames = {name: TABLE_FILES[name].replace('.npy', f'.{build}.npy') for name in tables}
+    for name, table in tables.items():
+        save_table(directory, name, table, filenames[name])
+
+    save_meta(directory, pin_length, build=build, tables=filenames, **extra)
+
+    # workers which already mapped them keep a valid mapping
+    for path in previous_paths - set(get_table_paths(directory, {'tables': filenames}).values()):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    return build
+
+
+def convert_legacy_stats(directory: str) -> List[str]:
+    """
+    Convert the pickled dumps of a stats directory to the memory-mappable format.
+    Return the names of the converted tables
+    """
+    converted = []
+    pin_length = None
+    for name, legacy_file in LEGACY_FILES.items():
+        legacy_path = os.path.join(directory, legacy_file)
+        if not os.path.exists(legacy_path):
+            continue
+
+        table = np.load(legacy_path, allow_pickle=True)
+        if name == 'prob_by_index':
+            pin_length = table.shape[1]
+        elif name == 'frequencies':
+            pin_length = int(round(np.log10(len(table))))
+
+        save_table(directory, name, table)
+        converted.append(name)
+
+    if pin_length is not None:
+        save_meta(directory, pin_length)
+    return converted
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert the pickled statistics dumps to the memory-mappable format")
+    parser.add_argument('directories', nargs='*', default=sorted(glob.glob('resources/stats/*_symbols')))
+    args = parser.parse_args()
+
+    for stats_dir in args.directories:
+        tables = convert_legacy_stats(stats_dir)
+        print(f"{stats_dir}: {', '.join(tables) if tables else 'nothing to convert'}")
@@ -69,8 +69,9 @@ const PhoneReferences: React.FC<PhoneReferencesProps> = ({
     formData.append("reference_file", event.target.files[0])
     api.post("api/build-statistics", formData)
       .then((response: AxiosResponse) => {
-        if (response.status === 201) {
-          displayStatus(response.data, 'success');
+        if (response.status === 202) {
+          displayStatus('The statistics are being built, this may take a while', 'info');
+          pollStatisticsBuild(response.data.id)
         }
       })
       .catch((err: AxiosError) => {
@@ -80,6 +81,29 @@ const PhoneReferences: React.FC<PhoneReferencesProps> = ({
       });
   }
 
+  // builds still unfinished after an hour of polling are left to the server
+  const maxStatisticsPolls = 3600
+
+  const pollStatisticsBuild = (jobId: number, polls: number = 0) => {
+    api.get(`api/build-statistics/${jobId}`)
+      .then((response: AxiosResponse) => {
+        if (response.data.status === 'done') {
+          displayStatus(response.data.message, 'success');
+        } else if (response.data.status === 'failed') {
+          displayStatus(response.data.message, 'error');
+        } else if (polls + 1 >= maxStatisticsPolls) {
+          displayStatus('The statistics are still being built, they will be available once done', 'warning');
+        } else {
+          setTimeout(() => pollStatisticsBuild(jobId, polls + 1), 1000)
+        }
+      })
+      .catch((err: AxiosError) => {
+        if (err.response) {
+          displayStatus(err.response.data, 'error');
+        }
+      });
+  }
+
   const handleUploadSmudgeTraces = () => {
     if (!inputValue) {
       displayStatus('Please enter a reference text.', 'error');
@@ -114,7 +138,7 @@ const PhoneReferences: React.FC<PhoneReferencesProps> = ({
               reference: response.data['reference'],
               inferred_bboxes: response.data['inferred_bboxes'],
               refs_bboxes: response.data['ref_bboxes'],
-              image: response.data['image'],
+              image: api.getUri({url: response.data['image']}),
               pin_codes: response.data['pin_codes']
             };
             setResult(prevRes => ({
@@ -134,7 +158,7 @@ const PhoneReferences: React.FC<PhoneReferencesProps> = ({
             const newInProcessResult: InProcessResult = {
               reference: inputValue,
               filename: response.data['filename'],
-              image: response.data['image'],
+              image: api.getUri({url: response.data['image']}),
               refs_bboxes: response.data['ref_bboxes'],
               inferred_bboxes: response.data['inferred_bboxes'],
               inferred_ciphers: response.data['inferred_ciphers'],
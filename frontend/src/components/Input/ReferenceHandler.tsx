@@ -51,16 +51,22 @@ const ReferenceHandler: React.FC<ReferenceHandlerProps> = ({
 
 
 
-  const loadReferences = () => {
-    api.get('/api/phone-references')
+  const loadReferences = (cursor: string | null = null, loaded: { [key: string]: number } = {}) => {
+    api.get('/api/phone-references', {params: cursor ? {cursor: cursor} : {}})
       .then((response: AxiosResponse) => {
         const refs = response.data['refs']
-        setPhoneReferences(refs.reduce(
+        const references = refs.reduce(
           (acc: { [key: string]: number }, ref: {ref: string, id: number}) => {
 
             acc[ref.ref] = ref.id
           return acc;
-        }, {} as { [key: string]: number }));
+        }, {...loaded} as { [key: string]: number });
+        // the references are listed by pages
+        if (response.data['next']) {
+          loadReferences(response.data['next'], references);
+          return;
+        }
+        setPhoneReferences(references);
         const newOrderGuessingAlgorithms = response.data['order_guessing_algorithms'].reduce(
           (acc: {[algo: string] : boolean}, algorithm: string) => {
           acc[algorithm] = true